@@ -0,0 +1,64 @@
+"""Compare the checksums of earlier versions with the current ones.
+
+The payloads resemble the calls made for every task: the check value of
+a C++ object (include paths, defines and flags), its primary checksum
+(the sets of input paths, their timestamps and outputs), the key of a
+cached function and a large check value which is shared as a tuple
+between many tasks.
+
+Usage: python benchmarks/checksum.py [--number N]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from cook.core import misc  # noqa: E402
+
+
+def payloads():
+    include = ['/home/user/project/include/module{}'.format(index)
+               for index in range(20)]
+    define = {'FEATURE_{}'.format(index): index % 3 and str(index) or None
+              for index in range(15)}
+    flags = ['-O2', '-g', '-Wall', '-Wextra', '-fPIC', '-std=c++17',
+             '-march=native', '-pthread']
+    check = [include, define, flags, False, True, True]
+    headers = {'/usr/include/c++/12/header{}'.format(index)
+               for index in range(80)}
+    inputs = headers | {'/home/user/project/src/main.cpp', '/usr/bin/g++'}
+    timestamps = {1700000000.0 + index * 0.37 for index in range(len(inputs))}
+    outputs = {'/home/user/project/build/.cook/intermediate/3f2a9c.o'}
+    shared = tuple('/opt/sdk/include/{}'.format(index)
+                   for index in range(200))
+    return {
+        'object check': (check,),
+        'primary': (inputs, timestamps, outputs, check),
+        'cached function': (('/usr/bin/g++', 'c++'), {'strict': True}),
+        'shared tuple': (shared, flags),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    print('{:<18}{:>14}{:>14}{:>10}'.format(
+        'payload', 'md5 (us)', 'blake2b (us)', 'speedup'))
+    for name, objects in payloads().items():
+        times = []
+        for compatible in (True, False):
+            misc.configure_checksum(compatible)
+            times.append(timeit.timeit(
+                lambda: misc.checksum(*objects), number=args.number
+            ) / args.number * 1e6)
+        print('{:<18}{:>14.2f}{:>14.2f}{:>9.1f}x'.format(
+            name, times[0], times[1], times[0] / times[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Measure the memory used by the graph per node.
+
+A synthetic graph is spawned in which every task compiles one source and
+a few shared headers are recorded as inputs, similar to C++ objects with
+their deposits. Groups of tasks are then linked together. The memory is
+measured with tracemalloc before and after the graph is frozen.
+
+Usage: python benchmarks/memory.py [--tasks N] [--headers N]
+"""
+
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from cook import core  # noqa: E402
+from cook.core import graph, system  # noqa: E402
+
+
+@core.rule
+def node(name, inputs=()):
+    yield core.publish(
+        inputs=inputs,
+        outputs=[core.build(name)],
+        message='Generate {}'.format(name),
+        check=name
+    )
+
+
+def generate(tasks, headers):
+    shared = [node('include/{}.h'.format(index)).output
+              for index in range(headers)]
+    objects = []
+    for index in range(tasks):
+        result = node('obj/{}.o'.format(index), shared)
+        objects.append(result.output)
+        if len(objects) == 100:
+            node('lib/{}.a'.format(index), objects)
+            objects = []
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=50000)
+    parser.add_argument('--headers', type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        system.initialize(directory)
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        generate(args.tasks, args.headers)
+        gc.collect()
+        loaded = tracemalloc.get_traced_memory()[0] - before
+        graph.freeze()
+        gc.collect()
+        frozen = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+
+    nodes = len(graph.paths) + len(graph.tasks)
+    print('files:  {}'.format(len(graph.paths)))
+    print('tasks:  {}'.format(len(graph.tasks)))
+    print('loaded: {:.0f} bytes per node'.format(loaded / nodes))
+    print('frozen: {:.0f} bytes per node'.format(frozen / nodes))
+
+
+if __name__ == '__main__':
+    main()
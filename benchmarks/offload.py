@@ -0,0 +1,86 @@
+"""Compare the thread and process executors on CPU-bound rules.
+
+A temporary project with many independent tasks is generated. Every
+task burns CPU in pure Python after its publication and then writes its
+output. The same build is run once with the default in-thread execution
+and once with the process pool enabled.
+
+Usage: python benchmarks/offload.py [-j JOBS] [--tasks N] [--rounds N]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from cook import core  # noqa: E402
+
+SCRIPT = '''\
+import offload
+
+for index in range({tasks}):
+    offload.spin('out/{{}}.txt'.format(index), {rounds})
+'''
+
+
+@core.rule
+def spin(name, rounds):
+    name = core.build(name)
+
+    yield core.publish(
+        outputs=[name],
+        message='Spin {}'.format(name),
+        check=rounds
+    )
+
+    yield core.offload(_spin, name, rounds)
+
+
+def _spin(name, rounds):
+    value = 0
+    for index in range(rounds):
+        value = (value * 31 + index) % 1000003
+    with open(name, 'w') as file:
+        file.write(str(value))
+
+
+def measure(directory, jobs, processes):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT, os.path.dirname(os.path.abspath(__file__))])
+    start = time.perf_counter()
+    subprocess.check_call(
+        [sys.executable, '-m', 'cook', '-j', str(jobs),
+         '-p', str(processes), '-o', 'build-{}'.format(processes)],
+        cwd=directory, env=env, stdout=subprocess.DEVNULL
+    )
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--tasks', type=int, default=64)
+    parser.add_argument('--rounds', type=int, default=500000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, 'BUILD.py'), 'w') as file:
+            file.write(SCRIPT.format(tasks=args.tasks, rounds=args.rounds))
+        threads = measure(directory, args.jobs, 0)
+        processes = measure(directory, args.jobs, args.jobs)
+
+    print('tasks:     {}'.format(args.tasks))
+    print('jobs:      {}'.format(args.jobs))
+    print('threads:   {:.2f}s'.format(threads))
+    print('processes: {:.2f}s ({:.1f}x)'.format(
+        processes, threads / processes))
+
+
+if __name__ == '__main__':
+    main()
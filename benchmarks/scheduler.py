@@ -0,0 +1,104 @@
+"""Compare FIFO and critical-path dispatch on a synthetic graph.
+
+The graph consists of a deep chain of expensive tasks (think of code
+generation followed by a series of links) and many cheap independent
+tasks (think of compiles), which are all spawned first. The build is
+simulated with the given number of jobs, so that the result only
+depends on the dispatch order and not on the machine.
+
+Usage: python benchmarks/scheduler.py [-j JOBS] [--depth N] [--width N]
+"""
+
+import argparse
+import heapq
+import itertools
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from cook import core  # noqa: E402
+from cook.core import graph, system  # noqa: E402
+
+
+@core.rule
+def node(name, inputs=()):
+    yield core.publish(
+        inputs=inputs,
+        outputs=[core.build(name)],
+        message=name
+    )
+
+
+def generate(depth, width):
+    costs = {}
+    for index in range(width):
+        costs[node('wide/{}'.format(index))._task] = 1.0
+    previous = []
+    for index in range(depth):
+        result = node('deep/{}'.format(index), previous)
+        costs[result._task] = 10.0
+        previous = [result.output]
+    return costs
+
+
+def simulate(costs, jobs, priorities=None):
+    """Return the wall time of the build with the given dispatch order."""
+    order = {task: index for index, task in enumerate(costs)}
+    if priorities is None:
+        def rank(task):
+            return order[task]
+    else:
+        def rank(task):
+            return -priorities[task], order[task]
+
+    waiting = {task: sum(1 for input in task.inputs if input.producer)
+               for task in costs}
+    ready = [(rank(task), order[task], task)
+             for task, count in waiting.items() if not count]
+    heapq.heapify(ready)
+    running = []
+    sequence = itertools.count()
+    now = 0.0
+
+    while ready or running:
+        while ready and len(running) < jobs:
+            _, _, task = heapq.heappop(ready)
+            heapq.heappush(
+                running, (now + costs[task], next(sequence), task))
+        now, _, task = heapq.heappop(running)
+        for output in task.outputs:
+            for dependant in output.dependants:
+                waiting[dependant] -= 1
+                if not waiting[dependant]:
+                    heapq.heappush(
+                        ready, (rank(dependant), order[dependant], dependant))
+    return now
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-j', '--jobs', type=int, default=8)
+    parser.add_argument('--depth', type=int, default=50)
+    parser.add_argument('--width', type=int, default=4000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        system.initialize(directory)
+        costs = generate(args.depth, args.width)
+
+    fifo = simulate(costs, args.jobs)
+    critical = simulate(costs, args.jobs, graph.critical_paths(costs, costs))
+    lower = max(sum(costs.values()) / args.jobs, 10.0 * args.depth)
+
+    print('tasks:         {}'.format(len(costs)))
+    print('jobs:          {}'.format(args.jobs))
+    print('lower bound:   {:.1f}'.format(lower))
+    print('fifo:          {:.1f}'.format(fifo))
+    print('critical path: {:.1f} ({:+.1%})'.format(
+        critical, critical / fifo - 1))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+"""Measure the overhead of cook on synthetic build trees.
+
+A tree of the given shape is generated for every number of sources: the
+sources are split evenly between several BUILD.py files, and each of
+them spawns a chain of levels. The first level has one task per source,
+every further level reads fan-in outputs of the previous one and has
+fan-out / fan-in times as many tasks. Every task deposits the same
+headers. The tasks only write a checksum of their inputs, so that the
+results reflect cook itself and not the work of the tasks.
+
+Measured are a cold build, a no-op build, a rebuild after editing a
+single source, the memory per graph node after loading and the time to
+load and compact the record. Results are written as JSON with -o and
+compared to an earlier result with --compare, e.g. of another version.
+
+Usage: python benchmarks/synthetic.py [--sources N [N ...]] [--depth N]
+                                      [--fan-in N] [--fan-out N]
+                                      [--deposits N] [--scripts N]
+                                      [-o FILE] [--compare FILE]
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from cook import core  # noqa: E402
+from cook.core import graph, loader, record, system  # noqa: E402
+
+SCRIPT = '''\
+import os
+import zlib
+
+from cook import core
+
+PART = {part}
+SOURCES = {sources}
+DEPTH = {depth}
+FAN_IN = {fan_in}
+FAN_OUT = {fan_out}
+DEPOSITS = {deposits}
+
+
+@core.rule
+def step(output, inputs, deposits):
+    yield core.publish(
+        inputs=inputs,
+        outputs=[output],
+        message='Step ' + os.path.relpath(output, core.build('.'))
+    )
+    checksum = 0
+    for input in inputs:
+        with open(input, 'rb') as file:
+            checksum = zlib.crc32(file.read(), checksum)
+    with open(output, 'w') as file:
+        file.write(str(checksum))
+    yield core.deposit(inputs=deposits)
+
+
+deposits = [core.resolve('../include/{{}}.h'.format(index))
+            for index in range(DEPOSITS)]
+previous = [core.resolve('{{}}.txt'.format(index))
+            for index in range(SOURCES)]
+for level in range(DEPTH):
+    if level:
+        count = max(1, len(previous) * FAN_OUT // FAN_IN)
+        reads, spread = FAN_IN, FAN_OUT
+    else:
+        count, reads, spread = len(previous), 1, 1
+    current = []
+    for index in range(count):
+        start = index * reads // spread
+        output = core.build('part{{}}/{{}}/{{}}'.format(PART, level, index))
+        step(output, [previous[(start + offset) % len(previous)]
+                      for offset in range(reads)], deposits)
+        current.append(output)
+    previous = current
+'''
+
+
+def generate(directory, sources, args):
+    """Write a tree with the given number of sources to the directory."""
+    os.makedirs(os.path.join(directory, 'include'))
+    for index in range(args.deposits):
+        with open(os.path.join(directory, 'include', '{}.h'.format(index)),
+                  'w') as file:
+            file.write('header\n')
+    with open(os.path.join(directory, 'BUILD.py'), 'w') as file:
+        file.write('from cook import core\n\n')
+        for part in range(args.scripts):
+            file.write("core.load('part{}')\n".format(part))
+    for part in range(args.scripts):
+        count = sources // args.scripts + (part < sources % args.scripts)
+        path = os.path.join(directory, 'part{}'.format(part))
+        os.makedirs(path)
+        for index in range(count):
+            source = os.path.join(path, '{}.txt'.format(index))
+            with open(source, 'w') as file:
+                file.write('source\n')
+        with open(os.path.join(path, 'BUILD.py'), 'w') as file:
+            file.write(SCRIPT.format(
+                part=part, sources=count, depth=args.depth,
+                fan_in=args.fan_in, fan_out=args.fan_out,
+                deposits=args.deposits))
+
+
+def cook(directory, jobs):
+    """Build the tree and return the wall time."""
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, '-m', 'cook', '-j', str(jobs)], cwd=directory,
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT,
+        check=True)
+    return time.perf_counter() - start
+
+
+def inner(kind, directory):
+    """Measure the graph or the record of the tree in this process."""
+    os.chdir(directory)
+    if kind == 'memory':
+        with tempfile.TemporaryDirectory() as output:
+            system.initialize(output)
+            gc.collect()
+            tracemalloc.start()
+            loader.load('BUILD.py')
+            gc.collect()
+            used = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+        return {
+            'files': len(graph.paths),
+            'tasks': len(graph.tasks),
+            'memory': used / (len(graph.paths) + len(graph.tasks)),
+        }
+    system.initialize('build')
+    start = time.perf_counter()
+    record.load()
+    loaded = time.perf_counter()
+    record.compact()
+    compacted = time.perf_counter()
+    return {
+        'record_load': loaded - start,
+        'record_save': compacted - loaded,
+    }
+
+
+def outer(kind, directory):
+    """Run inner() in a fresh process, so that nothing is shared."""
+    output = subprocess.check_output([
+        sys.executable, __file__, '--inner', kind, directory])
+    return json.loads(output.decode())
+
+
+def measure(sources, args):
+    with tempfile.TemporaryDirectory() as directory:
+        generate(directory, sources, args)
+        result = {'sources': sources}
+        result.update(outer('memory', directory))
+        result['cold'] = cook(directory, args.jobs)
+        result['noop'] = statistics.median(
+            cook(directory, args.jobs) for _ in range(args.repeat))
+        edits = []
+        leaf = os.path.join(directory, 'part0', '0.txt')
+        for _ in range(args.repeat):
+            with open(leaf, 'a') as file:
+                file.write('edit\n')
+            edits.append(cook(directory, args.jobs))
+        result['edit'] = statistics.median(edits)
+        result.update(outer('record', directory))
+    return result
+
+
+def show(results, previous=None):
+    columns = ('files', 'tasks', 'memory', 'cold', 'noop', 'edit',
+               'record_load', 'record_save')
+    earlier = {result['sources']: result for result in previous or ()}
+    print(('{:>9}' + '{:>13}' * len(columns)).format('sources', *columns))
+    for result in results:
+        cells = []
+        for column in columns:
+            value = result[column]
+            cell = '{:.0f}'.format(value) if column in (
+                'files', 'tasks', 'memory') else '{:.3f}'.format(value)
+            other = earlier.get(result['sources'], {}).get(column)
+            if other and column not in ('files', 'tasks'):
+                cell += ' {:+.0%}'.format(value / other - 1)
+            cells.append(cell)
+        print(('{:>9}' + '{:>13}' * len(cells)).format(
+            result['sources'], *cells))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sources', type=int, nargs='+',
+                        default=[1000, 10000])
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fan-in', type=int, default=4)
+    parser.add_argument('--fan-out', type=int, default=1)
+    parser.add_argument('--deposits', type=int, default=8)
+    parser.add_argument('--scripts', type=int, default=10)
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', metavar='FILE')
+    parser.add_argument('--compare', metavar='FILE')
+    parser.add_argument('--inner', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.inner:
+        print(json.dumps(inner(*args.inner)))
+        return
+
+    results = [measure(sources, args) for sources in args.sources]
+    previous = None
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)['results']
+    show(results, previous)
+    if args.output:
+        parameters = vars(args).copy()
+        for name in ('output', 'compare', 'inner'):
+            del parameters[name]
+        with open(args.output, 'w') as file:
+            json.dump({
+                'version': '.'.join(map(str, core.version)),
+                'python': platform.python_version(),
+                'parameters': parameters,
+                'results': results,
+            }, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,16 @@
 import argparse
+import functools
 import os
 import platform
 import sys
+import time
 import traceback
 import threading
 
-from .core import system, loader, events, builder
+from .core import (
+    system, loader, events, builder, pool, watch, daemon, snapshot, content,
+    artifacts, remote, distributed, record, metrics, misc, probes
+)
 from .core.misc import is_inside, relative
 
 windows = platform.system() == 'Windows'
@@ -20,12 +25,14 @@ if windows and not os.environ.get('TERM'):
     set_color = functools.partial(
         ctypes.windll.Kernel32.SetConsoleTextAttribute, stdout_handle)
 
-    def print_progress(percent, text):
+    def print_progress(percent, text, eta=None):
         with lock:
             print('[', end='', flush=True)
             set_color(10)
             print('{:>3}%'.format(percent), end='', flush=True)
             set_color(7)
+            if eta is not None:
+                print(' ETA', format_eta(eta), end='')
             print(']', text)
 
     def on_debug(msg):
@@ -61,8 +68,12 @@ if windows and not os.environ.get('TERM'):
             set_color(7)
             print(']', msg)
 else:
-    def print_progress(percent, text):
-        print('[\033[32m{:>3}%\033[0m]'.format(percent), text)
+    def print_progress(percent, text, eta=None):
+        if eta is None:
+            print('[\033[32m{:>3}%\033[0m]'.format(percent), text)
+        else:
+            print('[\033[32m{:>3}%\033[0m ETA {}]'.format(
+                percent, format_eta(eta)), text)
 
     def on_debug(msg):
         if verbose:
@@ -77,12 +88,20 @@ else:
     def on_error(msg):
         print('[\033[31mERROR\033[0m]', msg)
 
+# Environment variables which do not require the scripts to be reloaded.
+VOLATILE = {'OLDPWD', 'PWD', 'SHLVL', '_'}
+
 given = {}
 options = {}
 started = 0
 outdated = 0
 failed = 0
 verbose = False
+concurrency = 1
+durations = None
+finished = 0.0
+total = 0.0
+beginning = None
 
 
 def good_path(path):
@@ -113,7 +132,9 @@ def on_fail(task, exc):
 
         if verbose:
             print('Saved traceback (most recent call last):')
-            tb = remove_traceback_noise(task.stack)
+            tb = traceback.StackSummary.from_list(
+                [entry + (None,) for entry in task.stack])
+            tb = remove_traceback_noise(tb)
             print(''.join(traceback.format_list(tb)))
 
         if hasattr(exc, 'command'):
@@ -125,6 +146,10 @@ def on_fail(task, exc):
                 print(''.join(traceback.format_exception_only(type(exc), exc)))
                 print('$', exc.scommand)
             print(exc.output, end='')
+        elif hasattr(exc.__cause__, 'tb'):
+            # Exceptions raised by offloaded rules in a worker process only
+            # carry the formatted traceback of the process.
+            print(exc.__cause__.tb.strip('\n"'))
         else:
             tb = traceback.extract_tb(exc.__traceback__)
             tb = remove_traceback_noise(tb)
@@ -134,11 +159,48 @@ def on_fail(task, exc):
                 type(exc), exc)), end='')
 
 
+def format_eta(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{}:{:02}:{:02}'.format(hours, minutes, seconds)
+    return '{}:{:02}'.format(minutes, seconds)
+
+
 def on_start(job, task):
-    global started
-    percent = int(100 * started / outdated)
-    started += 1
-    print_progress(percent, task.message)
+    global started, beginning
+    with lock:
+        if beginning is None:
+            beginning = time.perf_counter()
+        started += 1
+        if durations is None:
+            percent = int(100 * (started - 1) / outdated)
+            eta = None
+        else:
+            # Weight the progress by the expected duration of the tasks
+            # and extrapolate the remaining time from the observed rate.
+            percent = int(100 * finished / total)
+            elapsed = time.perf_counter() - beginning
+            if finished:
+                eta = (total - finished) * elapsed / finished
+            else:
+                eta = total / concurrency
+    print_progress(min(percent, 99), task.message, eta)
+
+
+def on_done(task):
+    global finished
+    if durations is not None:
+        with lock:
+            finished += durations[task]
+
+
+def on_skip(task):
+    global outdated, total
+    with lock:
+        outdated -= 1
+        if durations is not None:
+            total = max(total - durations[task], 1e-9)
 
 
 def on_outdated(count):
@@ -146,6 +208,22 @@ def on_outdated(count):
     outdated = count
 
 
+def on_estimated(estimates):
+    global durations, total
+    durations = estimates
+    total = sum(estimates.values()) or 1.0
+
+
+def on_jobs(count):
+    global concurrency, started, outdated, failed, durations, finished, total
+    global beginning
+    # A new build is started, which happens repeatedly in watch mode.
+    concurrency = count
+    started = outdated = failed = 0
+    durations = beginning = None
+    finished = total = 0.0
+
+
 def main():
     global verbose
 
@@ -173,59 +251,102 @@ def main():
         help='Override build directory')
     arg('-f', '--fastfail', action='store_true',
         help='Immediately exit after first failed task')
+    arg('-a', '--async', action='store_true', dest='asynchronous',
+        help='Run commands on an event loop instead of threads')
+    arg('-l', '--limit', metavar='POOL=INT', action='append', default=[],
+        help='Limit the total weight of running tasks in a pool')
+    arg('--jobserver', choices=['fifo', 'pipe', 'none'],
+        help='Style of the jobserver for child processes (default: pipe)')
+    arg('-p', '--processes', type=int, metavar='INT', default=0,
+        help='Number of processes for offloaded rules (default: 0)')
+    arg('-w', '--watch', action='store_true',
+        help='Rebuild whenever an input file changes')
+    arg('-d', '--daemon', action='store_true',
+        help='Let a resident process of the build directory run the build')
+    arg('--serve', action='store_true', help=argparse.SUPPRESS)
+    arg('--hash', action='store_true',
+        help='Detect changes by the contents of files instead of timestamps')
+    arg('--checksums', choices=('auto', 'blake2b', 'md5'), default='auto',
+        help='Use the checksums of earlier versions (md5) or the faster ones '
+             '(blake2b), by default the ones of an existing record')
+    arg('--cache', metavar='PATH', nargs='?', const=artifacts.default(),
+        help='Reuse the outputs of earlier builds (also of removed build '
+             'directories) from a local cache (default: {})'.format(artifacts.default()))
+    arg('--cache-size', type=float, metavar='GB', default=5.0,
+        help='Size of the cache, beyond which the least recently used '
+             'entries are removed (default: 5)')
+    arg('--remote', metavar='URL',
+        help='Look up and store the outputs of tasks in a remote cache, '
+             'which implies --cache')
+    arg('--remote-read-only', action='store_true',
+        help='Do not upload to the remote cache')
+    arg('--serve-cache', metavar='[HOST:]PORT',
+        help='Serve the local cache to remote clients')
+    arg('--agent', metavar='HOST:PORT', action='append', default=[],
+        help='Run remote commands on the worker agent at the address')
+    arg('--serve-agent', metavar='[HOST:]PORT',
+        help='Act as a worker agent which runs remote commands of clients')
+    arg('--no-snapshot', action='store_true',
+        help='Always load the scripts instead of restoring the graph')
+    arg('--reprobe', action='store_true',
+        help='Probe the toolchain again instead of using the cached results')
     arg('rest', nargs='*', help=argparse.SUPPRESS)
     arg('--options', action='store_true', help='List all options and exit')
     arg('--targets', action='store_true', help='List all targets and exit')
+    arg('--gc', action='store_true',
+        help='Remove all non-declared files in the build directory and exit')
+    arg('--stats', action='store_true',
+        help='Show the overhead of cook itself after the build')
+    arg('--trace', metavar='FILE',
+        help='Write a timeline of the build in the Chrome trace format')
     arg('--results', action='store_true', help=argparse.SUPPRESS)
     args = parser.parse_args()
+    metrics.counting = args.stats
+    if args.trace is not None:
+        metrics.start_trace()
 
     verbose = args.verbose
+    if args.processes < 0:
+        on_error('The number of processes must not be negative')
+        return 1
+    pool.configure(args.processes)
+    content.configure(args.hash)
+    code = configure_cache(args)
+    if code is not None:
+        return code
     events.on_debug = on_debug
     events.on_info = on_info
     events.on_warning = on_warning
     events.on_error = on_error
     events.on_option = on_option
     events.on_start = on_start
+    events.on_done = on_done
     events.on_fail = on_fail
+    events.on_skip = on_skip
     events.on_outdated = on_outdated
+    events.on_estimated = on_estimated
+    events.on_jobs = on_jobs
 
-    request = set()
-    for entry in args.rest:
-        if '=' in entry:
-            key, value = entry.split('=', 1)
-            given[key.upper()] = value
-        else:
-            request.add(entry)
-
-    if os.path.isfile(args.build):
-        build = args.build
-    else:
-        build = os.path.join(args.build, 'BUILD.py')
-        if not os.path.isfile(build):
-            on_error('Could not find BUILD.py at {}'.format(
-                os.path.abspath(args.build)))
-            return 1
-
-    if args.output is None:
-        output = os.path.join(os.path.dirname(build), 'build/')
-    else:
-        output = args.output
-
-    system.initialize(output)
-    try:
-        loader.load(build)
-    except Exception as exc:
-        on_error('Failed to load BUILD.py - see below')
-        tb = traceback.extract_tb(exc.__traceback__)[2:]
-        tb = remove_traceback_noise(tb)
-        print('Traceback (most recent call last):')
-        print(''.join(traceback.format_list(tb)), end='')
-        print(''.join(traceback.format_exception_only(type(exc), exc)), end='')
-        return 2
+    distributed.configure(args.agent)
+    if args.serve_agent is not None:
+        host, _, port = args.serve_agent.rpartition(':')
+        distributed.serve(host or 'localhost', int(port))
+        return
+    elif args.serve_cache is not None:
+        host, _, port = args.serve_cache.rpartition(':')
+        remote.serve(args.cache or artifacts.default(), host or 'localhost',
+                     int(port))
+        return
+    elif args.daemon and not (args.options or args.targets or args.results or
+                            args.gc or args.watch or args.reprobe):
+        return connect(args)
+    elif args.serve:
+        return serve(parser, args, jobs)
 
-    remaining = {x.lower() for x in given} - {x.lower() for x in options}
-    if remaining:
-        raise ValueError('Invalid options - ' + ', '.join(remaining))
+    code = load(args)
+    if code is not None:
+        return code
+    output = locate(args)[1]
 
     if args.options:
         print('{:<10} {:<5} {:<10} {:<20}'.format(
@@ -237,6 +358,10 @@ def main():
                 name.lower(), tp.__name__, str(default), help))
         return
 
+    if args.gc:
+        record.collect()
+        return
+
     if args.targets:
         from .core import graph
         ignore = os.sep + '.cook' + os.sep
@@ -271,25 +396,274 @@ def main():
             json.dump(results, file, default=set_to_list)
         return
 
-    builder.start(args.jobs or jobs, request or None, args.fastfail)
+    try:
+        if not args.watch:
+            return build(args, jobs)
+        scripts = watch.run(functools.partial(build, args, jobs))
+    except KeyboardInterrupt:
+        if not args.watch:
+            raise
+        print('\r  \r', end='')
+        return
+    except snapshot.Reload:
+        # The restored graph can not be replaced by the loaded one, so the
+        # scripts are loaded by a new process instead.
+        restart()
+    on_info('Reloading after changes to {}'.format(
+        ', '.join(sorted(map(good_path, scripts)))))
+    restart()
+
+
+def restart():
+    sys.stdout.flush()
+    os.execv(sys.executable, [sys.executable, '-m', 'cook'] + sys.argv[1:])
 
+
+def split(rest):
+    """Separate the given options from the requested targets."""
+    values = {}
+    request = set()
+    for entry in rest:
+        if '=' in entry:
+            key, value = entry.split('=', 1)
+            values[key.upper()] = value
+        else:
+            request.add(entry)
+    return values, request
+
+
+def locate(args):
+    """Return the path of BUILD.py and the build directory."""
+    if os.path.isfile(args.build):
+        build = args.build
+    else:
+        build = os.path.join(args.build, 'BUILD.py')
+        if not os.path.isfile(build):
+            return None, None
+
+    if args.output is None:
+        output = os.path.join(os.path.dirname(build), 'build/')
+    else:
+        output = args.output
+    return build, output
+
+
+def load(args):
+    """Load the build scripts and return an exit code on failure."""
+    given.update(split(args.rest)[0])
+
+    build, output = locate(args)
+    if build is None:
+        on_error('Could not find BUILD.py at {}'.format(
+            os.path.abspath(args.build)))
+        return 1
+
+    system.initialize(output)
+    if args.checksums == 'auto':
+        misc.configure_checksum(record.legacy())
+    else:
+        misc.configure_checksum(args.checksums == 'md5')
+    if args.reprobe:
+        probes.invalidate()
+    with metrics.timed('load', 'Restore snapshot'):
+        restored = not (args.no_snapshot or args.reprobe) and (
+            snapshot.restore())
+    if restored:
+        return configure(args)
+    if not args.no_snapshot:
+        snapshot.start()
+    try:
+        with metrics.timed('load'):
+            loader.load(build)
+    except Exception as exc:
+        snapshot.stop()
+        on_error('Failed to load BUILD.py - see below')
+        tb = traceback.extract_tb(exc.__traceback__)[2:]
+        tb = remove_traceback_noise(tb)
+        print('Traceback (most recent call last):')
+        print(''.join(traceback.format_list(tb)), end='')
+        print(''.join(traceback.format_exception_only(type(exc), exc)), end='')
+        return 2
+    finally:
+        loader.save()
+    snapshot.save()
+    return configure(args)
+
+
+def configure(args):
+    """Apply the arguments which refer to the loaded scripts."""
+    for entry in args.limit:
+        name, _, capacity = entry.partition('=')
+        try:
+            try:
+                capacity = int(capacity)
+            except ValueError:
+                capacity = float(capacity)
+            builder.limit(name, capacity)
+        except ValueError:
+            on_error('Invalid pool limit "{}"'.format(entry))
+            return 1
+
+    remaining = {x.lower() for x in given} - {x.lower() for x in options}
+    if remaining:
+        raise ValueError('Invalid options - ' + ', '.join(remaining))
+
+
+def configure_cache(args):
+    """Configure the caches and return an exit code on errors."""
+    if args.remote is not None and args.cache is None:
+        args.cache = artifacts.default()
+    artifacts.configure(args.cache, int(args.cache_size * 1024 ** 3))
+    try:
+        remote.configure(args.remote, not args.remote_read_only)
+    except ValueError as exc:
+        on_error(str(exc))
+        return 1
+
+
+def build(args, jobs):
+    """Build the requested targets of the loaded scripts."""
+    request = split(args.rest)[1]
+    try:
+        builder.start(args.jobs or jobs, request or None, args.fastfail,
+                      args.asynchronous, args.jobserver)
+    except snapshot.Reload as exc:
+        on_debug('Loading the scripts, because {}.'.format(exc))
+        snapshot.discard()
+        raise
+    if args.trace is not None:
+        metrics.write_trace(args.trace)
+
+    code = None
     if not outdated:
         on_info('No work to do.')
     elif not failed:
         print_progress(100, 'Done.')
     else:
         on_warning('Failed tasks: {}'.format(failed))
+        code = 1
+    if args.stats:
+        from .core import graph
+        print(metrics.report(graph.tasks))
+    return code
+
+
+def configuration(args, cwd, env):
+    """Return everything that requires the scripts to be loaded again."""
+    env = {key: value for key, value in env.items() if key not in VOLATILE}
+    build, output = locate(args)
+    return (
+        cwd, build and os.path.abspath(build), output and
+        os.path.abspath(output), sorted(split(args.rest)[0].items()),
+        args.limit, args.hash, args.checksums, sorted(env.items())
+    )
+
+
+def connect(args):
+    """Let the daemon of the build directory run the build.
+
+    A daemon is started if there is none yet or if it has to restart.
+    """
+    build, output = locate(args)
+    if build is None:
+        on_error('Could not find BUILD.py at {}'.format(
+            os.path.abspath(args.build)))
         return 1
 
+    path = daemon.address(output)
+    arguments = ['--serve', '-b', args.build, '-o', output]
+    logfile = os.path.join(output, '.cook', 'daemon.log')
+    try:
+        for _ in range(2):
+            try:
+                code = daemon.request(path, sys.argv[1:], sys.stdout)
+            except (FileNotFoundError, ConnectionRefusedError):
+                daemon.spawn(path, arguments, logfile)
+                code = daemon.request(path, sys.argv[1:], sys.stdout)
+            if code is not None:
+                return code
+    except KeyboardInterrupt:
+        print('\r  \r', end='')
+        return 1
+    on_error('The daemon restarted unexpectedly - see {}'.format(logfile))
+    return 1
+
+
+def serve(parser, args, jobs):
+    """Act as the daemon for the build directory of the arguments."""
+    state = {}
+    watcher = watch.create()
+
+    def handle(argv, cwd, env):
+        global verbose
+        request = parser.parse_args(argv)
+        key = configuration(request, cwd, env)
+        metrics.counting = request.stats
+        metrics.reset()
+        if not state:
+            state['key'] = key
+            verbose = request.verbose
+            code = load(request)
+            if code is not None:
+                state['broken'] = True
+                return code
+            watcher.update(watch.watched(outputs=True))
+        elif state.get('broken') or key != state['key']:
+            raise daemon.Restart
+        else:
+            changed = watch.pending(watcher)
+            if changed.intersection(loader.loaded):
+                raise daemon.Restart
+            watch.invalidate(changed)
+
+        verbose = request.verbose
+        if request.trace is not None:
+            metrics.start_trace()
+        else:
+            metrics.stop_trace()
+        pool.configure(request.processes)
+        distributed.configure(request.agent)
+        code = configure_cache(request)
+        if code is not None:
+            return code
+        try:
+            code = build(request, jobs)
+        except snapshot.Reload:
+            raise daemon.Restart from None
+        watcher.update(watch.watched(outputs=True))
+        return code
+
+    try:
+        daemon.serve(daemon.address(locate(args)[1]), handle)
+    finally:
+        watcher.close()
+
 
 def remove_traceback_noise(tb):
     forbidden = (
         ('/core/loader.py', 'load', 'exec('),
+        ('/core/loader.py', 'load', 'compile('),
         ('/core/graph.py', 'spawn_task', 'next('),
         ('/core/builder.py', 'run', '.execute('),
-        ('/core/graph.py', 'execute', 'next('),
+        ('/core/graph.py', 'execute', 'next(steps)'),
+        ('/core/engine.py', 'work', 'self.execute('),
+        ('/core/engine.py', 'execute', 'run_in_executor('),
+        ('/core/engine.py', 'advance', 'step(value)'),
+        ('/concurrent/futures/thread.py', 'run', 'self.fn('),
+        ('/core/graph.py', 'execute', 'steps.'),
+        ('/core/graph.py', 'execute', 'command.call()'),
+        ('/core/graph.py', 'execute', 'call(command)'),
+        ('/core/distributed.py', 'call', 'command.call()'),
+        ('/core/graph.py', 'run', 'yield deposits'),
+        ('/core/misc.py', 'call', 'return call('),
+        ('/core/graph.py', 'run', 'next('),
+        ('/core/graph.py', 'run', 'generator.'),
+        ('/core/graph.py', 'run', 'pool.run('),
+        ('/core/pool.py', 'run', 'work.func('),
         ('', '<module>', 'load_entry_point('),
         ('/cook/__main__.py', 'main', 'load('),
+        ('/cook/__main__.py', 'handle', 'load('),
+        ('/cook/__main__.py', 'load', 'load('),
         ('/core/misc.py', 'call', 'raise')
     )
 
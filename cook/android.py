@@ -115,7 +115,7 @@ def native_app(name, sources=None, archs=None):
         _aapt, 'package', '-M', manifest, '-I', _android,
         '-S', res, '-J', res_dir, '-m', '-f'
     ]
-    core.call(res_cmd)
+    yield core.command(res_cmd)
     r = os.path.join(res_dir, *package.split('.'), 'R.java')
 
     cls_dir = core.temporary(core.random())
@@ -128,32 +128,32 @@ def native_app(name, sources=None, archs=None):
         _javac, '-d', cls_dir, '-classpath', clspath,
         '-sourcepath', srcpath, r, '-source', '1.7', '-target', '1.7'
     ]
-    core.call(comp_cmd)
+    yield core.command(comp_cmd)
 
     dex_dir = core.temporary(core.random())
     os.mkdir(dex_dir)
     cls_dex = os.path.join(dex_dir, 'classes.dex')
 
-    core.call([_dx, '--dex', '--output=' + cls_dex, cls_dir])
+    yield core.command([_dx, '--dex', '--output=' + cls_dex, cls_dir])
 
     unsigned = core.temporary(core.random('_unsigned.apk'))
     command = [
         _aapt, 'package', '-f', '-M', manifest, '-S', res, '-I', _android,
         '-F', unsigned, dex_dir, lib_dir
     ]
-    core.call(command)
+    yield core.command(command)
 
     signed = core.temporary(core.random('_signed.apk'))
 
     keys = os.path.expanduser('~/.android/debug.keystore')
-    core.call([
+    yield core.command([
         _signer, '-keystore', keys, '-storepass', 'android', '-keypass',
         'android', '-signedjar', signed, unsigned,
         '-sigalg', 'SHA1withRSA', '-digestalg', 'SHA1',  # TODO: REMOVE
         'androiddebugkey'
     ])
 
-    core.call([
+    yield core.command([
         _align, '-f', '4', signed, name
     ])
 
@@ -170,11 +170,11 @@ def install(name, app, launch=False):
         force=True
     )
 
-    core.call([
+    yield core.command([
         _adb, 'install', '-r', apk
     ])
 
     if launch:
-        core.call([
+        yield core.command([
             _adb, 'shell', 'monkey', '-p', app.package, '1'
         ])
@@ -1,11 +1,13 @@
-from .builder import default
+from .builder import default, limit
 from .loader import load, resolve, source
 from .log import debug, info, warning, error
 from .misc import (
     glob, which, linux, mac, windows, checksum, absolute, relative, call,
-    random, base_no_ext, extension, CallError, cache
+    random, base_no_ext, extension, CallError, cache, command
 )
 from .options import option
+from .pool import offload
+from .probes import probe
 from .rules import rule, publish, deposit, task
 from .system import build, temporary, intermediate
 
@@ -0,0 +1,267 @@
+"""Cache of task outputs which is shared between builds.
+
+If enabled, the outputs, deposits and warnings of every successful task
+are stored in a content-addressed directory (~/.cache/cook by default).
+Before the rest of a rule is run, the key of its task is looked up and
+on a hit, the outputs are restored instead. The key consists of the
+rule, the check value, the paths and contents of the inputs and the
+paths of the outputs. Paths are not relocated, because outputs may
+contain the build directory (e.g. the runpath of an executable), so
+only builds into the same directory share their entries.
+
+Deposits are only known after a task ran, which is why several variants
+may be stored for a key. A variant is only used if the contents of its
+deposits are still the same. Blobs are verified while being restored
+and the least recently used entries are removed if the cache exceeds
+its size. Entries which are missing locally are looked up in the remote
+cache, if one is configured (see remote).
+"""
+
+import functools
+import json
+import os
+import shutil
+import stat
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from . import content, log, misc, remote
+
+VERSION = 2
+
+# Number of variants with different deposits which are kept per key.
+VARIANTS = 8
+
+# The cache is trimmed below this fraction of its size, so that it does
+# not have to be trimmed again after the next build.
+LOW = 0.9
+
+# ioctl which shares the blocks of two files on Linux (e.g. btrfs, xfs).
+FICLONE = 0x40049409
+
+directory = None
+size = 5 * 1024 ** 3
+added = 0
+lock = threading.Lock()
+
+
+def default():
+    """Return the location of the cache of the current user."""
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'cook')
+
+
+def configure(path, budget=None):
+    """Enable the cache at the path with a size in bytes, or disable it."""
+    global directory, size
+    directory = path and os.path.abspath(path)
+    if budget is not None:
+        size = budget
+
+
+def key(task):
+    """Return the key of the task, or None if it can not be cached."""
+    if directory is None or task.phony or task.force or task.rule is None:
+        return None
+    func = task.rule[0]
+    inputs = sorted((file.path, content.digest(file.path))
+                    for file in task.inputs)
+    outputs = sorted(file.path for file in task.outputs)
+    return misc.checksum(
+        VERSION, func.__module__, func.__qualname__,
+        content.digest(func.__code__.co_filename), inputs, outputs,
+        task.check
+    )
+
+
+def restore(task, key):
+    """Restore the outputs of the task and return its deposits, or None."""
+    manifest = _location('actions', key)
+    variant = _select(_read(manifest))
+    if variant is None and remote.client is not None:
+        variant = _select(remote.client.manifest(key))
+        if variant is not None:
+            try:
+                _add(manifest, variant)
+            except OSError:
+                pass
+    if variant is None:
+        return None
+    if remote.client is not None and not remote.client.fetch(
+        [digest for digest, _ in variant['outputs'].values()],
+        functools.partial(_location, 'blobs')
+    ):
+        return None
+
+    try:
+        for path, (digest, mode) in variant['outputs'].items():
+            if not _extract(digest, path, mode):
+                return None
+        os.utime(manifest)
+    except OSError as exc:
+        log.debug('Could not restore {}: {}'.format(task.message, exc))
+        return None
+    log.debug('Restored from the cache: {}'.format(task.message))
+    return set(variant['deposits']), variant['warnings']
+
+
+def store(task, key, deposits):
+    """Add the outputs of the finished task to the cache."""
+    paths, warnings = deposits
+    try:
+        outputs = {}
+        for file in task.outputs:
+            mode = stat.S_IMODE(os.stat(file.path).st_mode)
+            outputs[file.path] = [_insert(file.path), mode]
+        variant = {
+            'deposits': {path: content.digest(path) for path in paths},
+            'outputs': outputs,
+            'warnings': warnings,
+        }
+        data = _add(_location('actions', key), variant)
+    except OSError as exc:
+        log.debug('Could not cache {}: {}'.format(task.message, exc))
+        return
+    if remote.client is not None:
+        remote.client.upload(key, data, {
+            digest: _location('blobs', digest)
+            for digest, _ in outputs.values()
+        })
+
+
+def trim():
+    """Remove the least recently used entries if the cache is too large."""
+    global added
+    if directory is None or not added:
+        return
+    added = 0
+
+    entries = []
+    total = 0
+    for kind in ('actions', 'blobs'):
+        for root, _, names in os.walk(os.path.join(directory, kind)):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+    if total <= size:
+        return
+
+    entries.sort()
+    removed = 0
+    for _, length, path in entries:
+        if total <= LOW * size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= length
+        removed += 1
+    log.debug('Removed {} entries from the cache.'.format(removed))
+
+
+def _read(manifest):
+    try:
+        with open(manifest) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _select(variants):
+    """Return the first variant whose deposits did not change."""
+    for variant in variants or ():
+        if all(content.digest(path) == digest
+               for path, digest in variant['deposits'].items()):
+            return variant
+    return None
+
+
+def _add(manifest, variant):
+    """Put the variant in front of the manifest and return its data."""
+    variants = [variant] + [
+        other for other in _read(manifest) or ()
+        if other['deposits'] != variant['deposits']
+    ][:VARIANTS - 1]
+    data = json.dumps(variants).encode()
+    _write(manifest, data)
+    return data
+
+
+def _insert(path):
+    """Copy the file into the cache and return the digest of its blob."""
+    global added
+    temporary = _temporary()
+    _clone(path, temporary)
+    digest = content.compute(temporary)
+    blob = _location('blobs', digest)
+    if os.path.isfile(blob):
+        os.remove(temporary)
+    else:
+        os.chmod(temporary, 0o444)
+        os.replace(temporary, blob)
+        with lock:
+            added += os.stat(blob).st_size
+    return digest
+
+
+def _extract(digest, path, mode):
+    """Restore a blob at the path and return False if it is broken."""
+    blob = _location('blobs', digest)
+    temporary = '{}.{}.tmp'.format(path, threading.get_ident())
+    try:
+        _clone(blob, temporary)
+    except FileNotFoundError:
+        return False
+    if content.compute(temporary) != digest:
+        log.warning('Removing corrupt blob from the cache: {}'.format(blob))
+        os.remove(temporary)
+        os.remove(blob)
+        return False
+    os.chmod(temporary, mode)
+    os.replace(temporary, path)
+    os.utime(blob)
+    return True
+
+
+def _clone(source, destination):
+    """Copy the file, sharing its blocks if the file system supports it."""
+    if fcntl is not None:
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return
+            except OSError:
+                pass
+    shutil.copyfile(source, destination)
+
+
+def _write(path, data):
+    temporary = _temporary()
+    with open(temporary, 'wb') as file:
+        file.write(data)
+    os.replace(temporary, path)
+
+
+def _location(kind, digest):
+    path = os.path.join(directory, kind, digest[:2], digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def _temporary():
+    path = os.path.join(directory, 'temporary', '{}.{}'.format(
+        os.getpid(), threading.get_ident()))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
@@ -1,12 +1,21 @@
+import contextlib
+import functools
+import heapq
+import itertools
 import os
 import queue
 import threading
 import signal
+import time
 
-from . import graph, events, record, log, system, misc
+from . import (
+    graph, events, record, log, system, misc, pool, jobserver, fs,
+    content, artifacts, remote, distributed, metrics, probes
+)
 
 defaults = set()
-todo = queue.Queue()
+capacities = {}
+todo = queue.PriorityQueue()
 done = queue.Queue()
 
 STOP = object()
@@ -14,12 +23,18 @@ STOP = object()
 
 # This should be rewritten, especially because task primary / secondary
 # calculation is kind of misplaced here. It is by far the worst function.
-def start(jobs, request=None, fastfail=False):
+def start(
+    jobs, request=None, fastfail=False, asynchronous=False,
+    jobserver_style=None
+):
+    global todo, done
+
     if not isinstance(jobs, int):
         raise TypeError('jobs must be of type int')
     elif jobs <= 0:
         raise ValueError('jobs must be greater than 0')
     events.on_jobs(jobs)
+    graph.freeze()
 
     # Determine requested files.
     if request is not None:
@@ -41,11 +56,24 @@ def start(jobs, request=None, fastfail=False):
         requested = {file for file in graph.paths.values() if file.producer}
 
     # All primaries must be calculated for record-cleaning and warning.
-    for task in graph.tasks:
-        task.calculate_primary()
-
-    # Calculate tasks to do. Record must be loaded first.
-    record.load()
+    # They are kept across repeated builds until they are invalidated.
+    with metrics.timed('primaries'):
+        fs.prefetch(graph.paths)
+        if content.enabled:
+            content.prefetch([path for path, file in graph.paths.items()
+                              if file.producer is None])
+        for task in graph.tasks:
+            if task.primary is None:
+                task.calculate_primary()
+
+    # Calculate tasks to do. Record must be loaded first, but is kept in
+    # memory for further builds of the same process.
+    if record.data is None:
+        with metrics.timed('record'):
+            record.load()
+    fs.prefetch(record.all_deposits())
+    if content.enabled:
+        content.prefetch(record.all_deposits())
     outdated = graph.all_outdated_tasks_for(requested)
     events.on_outdated(len(outdated))
 
@@ -58,98 +86,239 @@ def start(jobs, request=None, fastfail=False):
 
     # Skip everything if there are no outdated tasks.
     if not outdated:
-        record.clean()
-        record.save()
+        with metrics.timed('clean'):
+            record.clean()
+            record.save()
+            content.save(graph.paths)
+            probes.save()
         return
 
-    log.debug('Setup threads.')
-    for identifier in range(jobs):
-        Worker(identifier).start()
+    # Rules of the scripts are missing if the graph was restored.
+    from . import snapshot
+    snapshot.require(outdated)
+
+    jobserver.start(jobs, jobserver_style)
+
+    # Every build uses its own queues, so that results of tasks which are
+    # still running after an abort do not leak into the next build.
+    todo = queue.PriorityQueue()
+    done = queue.Queue()
+    # Local slots, which are also taken by the workers of agents while
+    # they run something locally.
+    slots = threading.Semaphore(jobs)
+    if asynchronous:
+        # The engine is imported lazily, because coroutines are a syntax
+        # error before Python 3.5.
+        from . import engine
+        log.debug('Setup event loop.')
+        workers = [engine.Engine(jobs, todo, done, slots)]
+    else:
+        log.debug('Setup threads.')
+        workers = [Worker(identifier, todo, done, slots)
+                   for identifier in range(jobs)]
+    # Remote slots are used by additional workers.
+    agents = distributed.connect()
+    workers.extend(Worker(jobs + index, todo, done, slots, agent)
+                   for index, agent in enumerate(agents))
+    for worker in workers:
+        worker.start()
+
+    # Ready tasks are dispatched by the length of their critical path, so
+    # that the longest chains are started as early as possible.
+    durations = graph.estimate_durations(outdated)
+    if durations is not None:
+        events.on_estimated(durations)
+    priorities = graph.critical_paths(outdated, durations)
+    sequence = itertools.count()
+
+    # Tasks in a pool without remaining capacity are held back here, while
+    # all other tasks can still be dispatched.
+    usage = dict.fromkeys(capacities, 0)
+    waiting = {name: [] for name in capacities}
+    for name, capacity in sorted(capacities.items()):
+        log.debug('Pool "{}" has a capacity of {}.'.format(name, capacity))
+
+    def admits(task):
+        used = usage[task.pool]
+        return not used or used + task.weight <= capacities[task.pool]
+
+    def dispatch(entry):
+        task = entry[2]
+        if task.pool in usage:
+            usage[task.pool] += task.weight
+        dispatched.add(task)
+        todo.put(entry)
+
+    def schedule(task):
+        added.add(task)
+        current.add(task)
+        if task.generator is None:
+            try:
+                task.restart()
+            except Exception as exc:
+                done.put((task, exc, None, None))
+                return
+        entry = (-priorities[task], next(sequence), task)
+        if task.pool in usage and not admits(task):
+            log.debug('Waiting for pool "{}" ({}/{} used): {}'.format(
+                task.pool, usage[task.pool], capacities[task.pool],
+                task.message))
+            heapq.heappush(waiting[task.pool], entry)
+        else:
+            dispatch(entry)
+
+    def release(task):
+        # Tasks which failed to restart were never dispatched.
+        if task not in dispatched:
+            return
+        dispatched.remove(task)
+        if task.pool in usage:
+            usage[task.pool] -= task.weight
+            pending = waiting[task.pool]
+            while pending and admits(pending[0][2]):
+                dispatch(heapq.heappop(pending))
 
     added = set()
     current = set()
+    dispatched = set()
 
     for task in outdated:
         if not any(input.producer in outdated for input in task.inputs):
-            added.add(task)
-            todo.put(task)
-            current.add(task)
+            schedule(task)
 
     def handle(signal, frame):
         print('\r  \r', end='', flush=True)
-        done.put((STOP, None, None))
+        abort()
 
-    signal.signal(signal.SIGINT, handle)
+    previous = signal.signal(signal.SIGINT, handle)
 
     failed = set()
+    changed = set()
+    started = time.perf_counter()
     while current:
         if misc.windows:
             # Signal handling does not work very well on Windows...
             while True:
                 try:
-                    task, exc, deposits = done.get(timeout=0.1)
+                    task, exc, deposits, digest = done.get(timeout=0.1)
                     break
                 except queue.Empty:
                     pass
         else:
-            task, exc, deposits = done.get()
+            task, exc, deposits, digest = done.get()
 
         if task is STOP:
             log.error('Aborting {} running tasks.'.format(len(current)))
             # TODO: Remove outputs?
             break
 
-        current.remove(task)
-        outdated.remove(task)
+        with metrics.timed('schedule', 'Completed ' + task.message):
+            current.remove(task)
+            outdated.remove(task)
+            release(task)
 
-        if exc:
-            failed.add(task)
-            events.on_fail(task, exc)
-            # TODO: Remove outputs?
-            if fastfail:
-                log.error('Aborting {} running tasks.'.format(len(current)))
+            if exc:
+                failed.add(task)
+                events.on_fail(task, exc)
                 # TODO: Remove outputs?
-                break
-            continue
-
-        events.on_done(task)
-
-        # Put all tasks in queue that can and should be done.
-        for output in task.outputs:
-            for dependant in output.dependants:
-                if (
-                    dependant in outdated and
-                    dependant not in added and
-                    all(
-                        input.producer not in outdated and
-                        input.producer not in failed
-                        for input in dependant.inputs
-                    )
-                ):
-                    added.add(dependant)
-                    todo.put(dependant)
-                    current.add(dependant)
-
-        task.deposits = {graph.get_file(deposit) for deposit in deposits[0]}
-        task.warnings = deposits[1]
-
-        if task.warnings is not None:
-            log.warning('Warnings by {}:\n{}'.format(
-                task.primary, task.warnings))
-
-        task.calculate_secondary()
-        record.update(task)
-
-    record.clean()
-    record.save()
-
-
-def fail(task, exc):
-    try:
-        done.put((task, exc, None))
-    except Exception as exc:
-        print(exc)
-        return
+                if fastfail:
+                    log.error('Aborting {} running tasks.'.format(
+                        len(current)))
+                    # TODO: Remove outputs?
+                    break
+                continue
+
+            events.on_done(task)
+
+            # Early cutoff: if the outputs are identical to the ones of the
+            # previous run, dependants which are not dirty on their own are
+            # skipped instead of being executed. The digest was calculated
+            # by the worker.
+            if digest is None or record.compare_outputs(task, digest):
+                changed.add(task)
+
+            # Put all tasks in queue that can and should be done.
+            finished = [task]
+            while finished:
+                for output in finished.pop().outputs:
+                    for dependant in output.dependants:
+                        if (
+                            dependant not in outdated or
+                            dependant in added or
+                            any(
+                                input.producer in outdated or
+                                input.producer in failed
+                                for input in dependant.inputs
+                            )
+                        ):
+                            continue
+                        if (
+                            not any(input.producer in changed
+                                    for input in dependant.inputs) and
+                            not dependant.is_dirty()
+                        ):
+                            log.debug('Skipping unaffected task: {}'.format(
+                                dependant.message))
+                            outdated.remove(dependant)
+                            events.on_skip(dependant)
+                            finished.append(dependant)
+                        else:
+                            schedule(dependant)
+
+            task.deposits = {graph.get_file(deposit)
+                             for deposit in deposits[0]}
+            task.warnings = deposits[1]
+
+            if task.warnings is not None:
+                log.warning('Warnings by {}:\n{}'.format(
+                    task.primary, task.warnings))
+
+            task.calculate_secondary()
+            record.update(task)
+
+    # Tasks which were not started because of an abort are dropped, then
+    # the workers are stopped once they are idle. Tasks which are still
+    # running hold job slots, which must be returned before the jobserver
+    # is stopped, so their processes are terminated instead of waited for.
+    while not todo.empty():
+        todo.get_nowait()
+    if current:
+        misc.terminate()
+        distributed.interrupt(agents)
+    for _ in range(jobs + len(agents)):
+        todo.put((float('inf'), next(sequence), None))
+    for worker in workers:
+        worker.join()
+    misc.resume()
+    distributed.disconnect(agents)
+    metrics.add('execution', started)
+
+    signal.signal(signal.SIGINT, previous)
+    pool.shutdown()
+    jobserver.stop()
+    with metrics.timed('clean'):
+        record.clean()
+        record.save()
+        content.save(graph.paths)
+        probes.save()
+    remote.finish()
+    artifacts.trim()
+
+
+def abort():
+    """Stop the running build as if it was interrupted."""
+    done.put((STOP, None, None, None))
+
+
+def limit(pool, capacity):
+    """Restrict the total weight of the running tasks of a pool."""
+    if not isinstance(pool, str):
+        raise TypeError('pool must be of type str')
+    elif not isinstance(capacity, (int, float)):
+        raise TypeError('capacity must be a number')
+    elif capacity <= 0:
+        raise ValueError('capacity must be greater than 0')
+    capacities[pool] = capacity
 
 
 def default(*results):
@@ -161,20 +330,54 @@ def default(*results):
 
 
 class Worker(threading.Thread):
-    def __init__(self, identifier):
+    def __init__(self, identifier, todo, done, slots, agent=None):
         super().__init__()
         self.daemon = True
         self.identifier = identifier
+        self.todo = todo
+        self.done = done
+        self.slots = slots
+        self.agent = agent
+        self.token = None
 
     def run(self):
         while True:
-            task = todo.get()
+            _, _, task = self.todo.get()
+            if task is None:
+                return
+            self.slots.acquire()
+            self.token = jobserver.acquire()
+            call = None
+            if self.agent is not None:
+                call = functools.partial(self.agent.call, task, self.detach)
             events.on_start(self.identifier, task)
+            start = time.perf_counter()
+            lane = self.identifier + 1
             try:
-                task.prepare()
-                deposits = task.execute()
-                task.finalize()
+                with metrics.traced(task.message, lane, task):
+                    with metrics.traced('prepare', lane):
+                        task.prepare()
+                    with metrics.traced('execute', lane):
+                        deposits = task.execute(call)
+                    with metrics.traced('finalize', lane):
+                        task.finalize()
+                        digest = task.digest()
             except Exception as exc:
-                fail(task, exc)
+                result = task, exc, None, None
             else:
-                done.put((task, None, deposits))
+                task.duration = time.perf_counter() - start
+                result = task, None, deposits, digest
+            jobserver.release(self.token)
+            self.slots.release()
+            self.done.put(result)
+
+    @contextlib.contextmanager
+    def detach(self):
+        """Give the local slot back while a command runs on the agent."""
+        jobserver.release(self.token)
+        self.slots.release()
+        try:
+            yield
+        finally:
+            self.slots.acquire()
+            self.token = jobserver.acquire()
@@ -0,0 +1,125 @@
+"""Digests of file contents for change detection.
+
+If enabled, the contents of the files are used for the checksums of the
+tasks instead of their timestamps, so that touching a file or checking
+it out again does not cause a rebuild. Digests are cached in
+.cook/digests.json and keyed by (st_dev, st_ino, st_size, st_mtime_ns),
+which means that a file is only read again if its metadata changed.
+Large files are split into chunks, which are hashed in parallel.
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import time
+
+from . import fs, system
+
+# Size of the chunks of large files, which are hashed in parallel.
+CHUNK = 4 * 1024 * 1024
+
+# Files changed within this many seconds might change again without a
+# different timestamp, so their digests are only kept in memory.
+RACY = 1.0
+
+THREADS = os.cpu_count() or 4
+
+enabled = False
+cache = None
+used = set()
+racy = set()
+lock = threading.Lock()
+executor = None
+
+
+def configure(enable):
+    global enabled
+    enabled = enable
+
+
+def load():
+    global cache
+    path = system.build('.cook/digests.json')
+    if os.path.isfile(path):
+        with open(path) as file:
+            cache = json.load(file)
+    else:
+        cache = {}
+
+
+def save(keep=()):
+    """Write the digests which were used or belong to kept paths."""
+    if cache is None:
+        return
+    data = {path: entry for path, entry in cache.items()
+            if (path in used or path in keep) and path not in racy}
+    with open(system.build('.cook/digests.json'), 'w') as file:
+        json.dump(data, file)
+
+
+def digest(path):
+    """Return the digest of the contents of the file or None."""
+    st = fs.stat(path)
+    if st is None:
+        return None
+    key = [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns]
+
+    with lock:
+        if cache is None:
+            load()
+        used.add(path)
+        entry = cache.get(path)
+    if entry is not None and entry[:4] == key:
+        return entry[4]
+
+    result = _hash(path, st.st_size)
+    with lock:
+        cache[path] = key + [result]
+        if time.time() - st.st_mtime > RACY:
+            racy.discard(path)
+        else:
+            racy.add(path)
+    return result
+
+
+def compute(path):
+    """Return the digest of the file without using the cache."""
+    return _hash(path, os.stat(path).st_size)
+
+
+def prefetch(paths):
+    """Calculate the digests of many files at once."""
+    global executor
+    with lock:
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(THREADS)
+    for _ in executor.map(digest, paths):
+        pass
+
+
+def _hash(path, size):
+    with open(path, 'rb') as file:
+        if size <= 2 * CHUNK:
+            return hashlib.blake2b(file.read(), digest_size=16).hexdigest()
+
+        combined = hashlib.blake2b(digest_size=16)
+        if hasattr(os, 'pread'):
+            # The chunks are read and hashed on separate threads, since
+            # hashlib releases the GIL for large buffers.
+            fd = file.fileno()
+
+            def chunk(offset):
+                return hashlib.blake2b(
+                    os.pread(fd, CHUNK, offset), digest_size=16).digest()
+
+            with concurrent.futures.ThreadPoolExecutor(THREADS) as pool:
+                for part in pool.map(chunk, range(0, size, CHUNK)):
+                    combined.update(part)
+        else:
+            for _ in range(0, size, CHUNK):
+                combined.update(hashlib.blake2b(
+                    file.read(CHUNK), digest_size=16).digest())
+        combined.update(str(size).encode())
+        return combined.hexdigest()
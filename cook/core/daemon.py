@@ -0,0 +1,178 @@
+"""A resident process which serves builds over a Unix socket.
+
+The daemon keeps the graph, the record and the stat cache of a build
+directory in memory. Clients send their command line, environment and
+working directory as a single JSON line. Everything the daemon prints
+while handling the request is streamed back as JSON lines, followed by
+the exit code. If the request can not be served with the loaded state,
+the daemon answers that it restarts and exits, so that the client can
+spawn a fresh one.
+"""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from . import builder, log
+
+# Seconds without requests after which the daemon exits.
+TIMEOUT = 30 * 60
+
+# Seconds a client waits for a freshly spawned daemon.
+STARTUP = 10
+
+# Unix socket paths are limited to about 100 bytes on most platforms.
+MAXIMUM = 100
+
+
+class Restart(Exception):
+    """Raised by the handler if the loaded state does not fit a request."""
+
+
+class Stream:
+    """Replacement for sys.stdout which sends everything to the client."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.closed = False
+
+    def write(self, text):
+        if text and not self.closed:
+            try:
+                send(self.connection, {'output': text})
+            except OSError:
+                # The client is gone (e.g. interrupted), so the build is
+                # aborted just like after a local interrupt.
+                self.closed = True
+                builder.abort()
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def address(build_dir):
+    """Return the location of the socket for the build directory."""
+    path = os.path.join(os.path.abspath(build_dir), '.cook', 'daemon.sock')
+    if len(path) > MAXIMUM:
+        path = os.path.relpath(path)
+    return path
+
+
+def send(connection, message):
+    connection.sendall(json.dumps(message).encode() + b'\n')
+
+
+def receive(reader):
+    line = reader.readline()
+    if not line:
+        return None
+    return json.loads(line.decode())
+
+
+def serve(path, handle):
+    """Serve requests with handle(argv, cwd, env) until being idle.
+
+    The handler returns the exit code for the client and may raise
+    Restart. Requests are handled one after another on the main thread.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(8)
+    server.settimeout(TIMEOUT)
+    log.debug('Serving on {}'.format(path))
+
+    try:
+        while True:
+            try:
+                connection, _ = server.accept()
+            except socket.timeout:
+                log.debug('Exiting after being idle.')
+                return
+            connection.settimeout(None)
+            with connection:
+                request = receive(connection.makefile('rb'))
+                if request is None:
+                    # Probed by a client which waits for the startup.
+                    continue
+                stdout, sys.stdout = sys.stdout, Stream(connection)
+                try:
+                    code = handle(
+                        request['argv'], request['cwd'], request['env'])
+                except Restart:
+                    # The socket is removed before answering, so that it
+                    # can not remove the one of the next daemon.
+                    server.close()
+                    os.remove(path)
+                    path = None
+                    send(connection, {'restart': True})
+                    return
+                finally:
+                    sys.stdout.flush()
+                    sys.stdout = stdout
+                try:
+                    send(connection, {'exit': code or 0})
+                except OSError:
+                    pass
+    finally:
+        server.close()
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+
+def request(path, argv, out):
+    """Let the daemon at the path run a build and return the exit code.
+
+    None is returned if the daemon restarts. Raises OSError if there is
+    no daemon listening at the path.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with client:
+        client.connect(path)
+        send(client, {
+            'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)
+        })
+        reader = client.makefile('rb')
+        while True:
+            message = receive(reader)
+            if message is None:
+                raise ConnectionError('Connection closed by the daemon')
+            elif 'output' in message:
+                out.write(message['output'])
+                out.flush()
+            elif 'restart' in message:
+                return None
+            else:
+                return message['exit']
+
+
+def spawn(path, argv, logfile):
+    """Start a detached daemon and wait until it listens at the path."""
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(logfile, 'a') as output:
+        subprocess.Popen(
+            [sys.executable, '-m', 'cook'] + argv, stdin=subprocess.DEVNULL,
+            stdout=output, stderr=subprocess.STDOUT, start_new_session=True
+        )
+
+    deadline = time.monotonic() + STARTUP
+    while time.monotonic() < deadline:
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        with probe:
+            try:
+                probe.connect(path)
+            except OSError:
+                time.sleep(0.05)
+            else:
+                return
+    raise RuntimeError('Daemon did not start - see {}'.format(logfile))
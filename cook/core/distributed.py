@@ -0,0 +1,338 @@
+"""Execution of remote commands on worker agents over TCP.
+
+Agents are started with "cook --serve-agent [HOST:]PORT" and offer one
+slot per core. The builder opens a connection for every slot of the
+configured agents and runs an additional worker on each of them, so
+that remote slots add to the local jobs. Those workers run commands
+which were requested with core.command(..., remote=True) on their agent
+and everything else locally, for which they take a local job slot.
+
+The inputs and the latest deposits of the task which are inside of the
+working directory are sent along with the command, but the agent only
+receives the contents it does not know yet by their digest. Paths into
+the working directory are made relative, the command is run in a
+scratch directory and all files it created are sent back. Everything
+outside of the working directory (e.g. the toolchain and the system
+headers) must be the same on the agents.
+
+The deposits of the latest run may be outdated (e.g. if a header is
+included now) or unknown, so the command may need files which were not
+sent. A command which failed remotely is therefore run locally again.
+Agents run arbitrary commands, so they must only be reachable by
+trusted clients.
+"""
+
+import os
+import shutil
+import socket
+import socketserver
+import stat
+import subprocess
+import tempfile
+import threading
+
+from . import artifacts, content, daemon, fs, log, record
+
+# Seconds to wait for an agent while connecting.
+TIMEOUT = 10
+
+addresses = []
+
+
+class Agent:
+    """A connection to a slot of an agent, used by a single worker."""
+
+    def __init__(self, address, connection):
+        self.address = address
+        self.connection = connection
+        self.reader = connection.makefile('rb')
+        self.broken = False
+
+    def call(self, task, detach, command):
+        """Run the command of the task remotely if possible.
+
+        Returns the output like misc.call(), which is used to run the
+        command locally otherwise. The local slot of the worker is given
+        back within detach() while the agent runs the command.
+        """
+        root = os.getcwd()
+        cwd = root if command.cwd is None else os.path.abspath(command.cwd)
+        if command.remote and not self.broken and _relative(cwd, root):
+            deposits = record.get_known_deposits(task)
+            try:
+                with detach():
+                    code, output = self.execute(
+                        task, command, root, cwd, deposits)
+            except (OSError, ValueError, KeyError) as exc:
+                # The connection is broken on purpose by interrupt().
+                if not self.broken:
+                    log.warning('Lost the connection to agent {}: {}'.format(
+                        self.address, exc))
+                self.broken = True
+            else:
+                if not code:
+                    return output
+                log.debug('Running locally after remote failure: {}'.format(
+                    task.message))
+        return command.call()
+
+    def execute(self, task, command, root, cwd, deposits):
+        files = {}
+        for path in [file.path for file in task.inputs] + (deposits or []):
+            relative = _relative(path, root)
+            if relative and fs.isfile(path):
+                files[relative] = path
+        entries = {
+            relative: [content.digest(path),
+                       stat.S_IMODE(os.stat(path).st_mode)]
+            for relative, path in files.items()
+        }
+        arguments = [_rewrite(argument, root) for argument in command.command]
+        # The directories of the outputs must exist, which are guessed
+        # from the arguments.
+        directories = set()
+        for argument in arguments:
+            directory = os.path.join(cwd, os.path.dirname(argument))
+            if not os.path.isabs(argument) and os.path.isdir(directory):
+                directories.add(_relative(directory, root))
+        directories.discard(None)
+
+        daemon.send(self.connection, {
+            'command': arguments,
+            'cwd': _relative(cwd, root),
+            'env': command.env,
+            'timeout': command.timeout,
+            'files': entries,
+            'directories': sorted(directories),
+        })
+        missing = self.receive()['missing']
+        paths = {entries[relative][0]: path
+                 for relative, path in files.items()}
+        for digest in missing:
+            with open(paths[digest], 'rb') as file:
+                daemon.send(self.connection, {
+                    'size': os.fstat(file.fileno()).st_size})
+                self.connection.sendfile(file)
+
+        reply = self.receive()
+        if 'error' in reply:
+            raise ValueError(reply['error'])
+        for relative, size, mode in reply['files']:
+            path = os.path.join(root, relative)
+            if not _relative(path, root):
+                raise ValueError('invalid path {}'.format(relative))
+            _receive(self.reader, path, size, mode)
+            fs.invalidate(path)
+        return reply['code'], reply['output']
+
+    def receive(self):
+        message = daemon.receive(self.reader)
+        if message is None:
+            raise ConnectionError('Connection closed by the agent')
+        return message
+
+    def interrupt(self):
+        """Stop waiting for the agent, e.g. on an abort."""
+        self.broken = True
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        self.reader.close()
+        self.connection.close()
+
+
+def configure(agents):
+    """Use the agents at the given "HOST:PORT" addresses."""
+    addresses[:] = agents
+
+
+def connect():
+    """Open a connection to every slot of the configured agents."""
+    agents = []
+    for address in addresses:
+        host, _, port = address.rpartition(':')
+        try:
+            connection = socket.create_connection((host, int(port)), TIMEOUT)
+            first = Agent(address, connection)
+            slots = first.receive()['slots']
+            agents.append(first)
+            for _ in range(slots - 1):
+                agent = Agent(address, socket.create_connection(
+                    (host, int(port)), TIMEOUT))
+                agent.receive()
+                agents.append(agent)
+        except (OSError, ValueError, KeyError) as exc:
+            log.warning('Could not connect to agent {}: {}'.format(
+                address, exc))
+            continue
+        log.debug('Connected to agent {} with {} slots.'.format(
+            address, slots))
+    for agent in agents:
+        agent.connection.settimeout(None)
+    return agents
+
+
+def interrupt(agents):
+    for agent in agents:
+        agent.interrupt()
+
+
+def disconnect(agents):
+    for agent in agents:
+        agent.close()
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """Run the commands of a client on a slot of the agent."""
+
+    def handle(self):
+        daemon.send(self.request, {'slots': self.server.slots})
+        while True:
+            message = daemon.receive(self.rfile)
+            if message is None:
+                return
+            self.run(message)
+
+    def run(self, message):
+        store = self.server.store
+        files = message['files']
+        missing = sorted({
+            digest for digest, _ in files.values()
+            if not os.path.isfile(os.path.join(store, digest))
+        })
+        daemon.send(self.request, {'missing': missing})
+        corrupt = None
+        for digest in missing:
+            size = daemon.receive(self.rfile)['size']
+            temporary = os.path.join(store, '{}.{}.tmp'.format(
+                digest, threading.get_ident()))
+            _receive(self.rfile, temporary, size, 0o444)
+            if content.compute(temporary) != digest:
+                os.remove(temporary)
+                corrupt = digest
+            else:
+                os.replace(temporary, os.path.join(store, digest))
+        if corrupt is not None:
+            daemon.send(self.request, {
+                'error': 'file changed while sending: {}'.format(corrupt)})
+            return
+
+        scratch = tempfile.mkdtemp(dir=self.server.scratch)
+        try:
+            paths = [message['cwd']] + message['directories'] + list(files)
+            if not all(_relative(os.path.join(scratch, path), scratch)
+                       for path in paths):
+                daemon.send(self.request, {'error': 'invalid path'})
+                return
+            for directory in message['directories']:
+                os.makedirs(os.path.join(scratch, directory), exist_ok=True)
+            for relative, (digest, mode) in files.items():
+                path = os.path.join(scratch, relative)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                blob = os.path.join(store, digest)
+                if not mode & 0o111:
+                    # Blobs are read-only, so they can be shared.
+                    try:
+                        os.link(blob, path)
+                        continue
+                    except OSError:
+                        pass
+                shutil.copyfile(blob, path)
+                os.chmod(path, mode)
+
+            with self.server.limit:
+                code, output = _run(
+                    message['command'],
+                    os.path.join(scratch, message['cwd']),
+                    message['env'], message['timeout'])
+
+            created = []
+            if not code:
+                for directory, _, names in os.walk(scratch):
+                    for name in names:
+                        path = os.path.join(directory, name)
+                        relative = os.path.relpath(path, scratch)
+                        if relative not in files:
+                            created.append((relative, path))
+            daemon.send(self.request, {
+                'code': code,
+                'output': output,
+                'files': [
+                    [relative, os.path.getsize(path),
+                     stat.S_IMODE(os.stat(path).st_mode)]
+                    for relative, path in created
+                ],
+            })
+            for _, path in created:
+                with open(path, 'rb') as file:
+                    self.request.sendfile(file)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+
+def serve(host='localhost', port=8800, slots=None, directory=None):
+    """Act as an agent until being interrupted."""
+    if directory is None:
+        directory = os.path.join(artifacts.default(), 'agent')
+    server = socketserver.ThreadingTCPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.slots = slots or os.cpu_count() or 1
+    server.limit = threading.Semaphore(server.slots)
+    server.store = os.path.join(directory, 'files')
+    server.scratch = os.path.join(directory, 'scratch')
+    os.makedirs(server.store, exist_ok=True)
+    os.makedirs(server.scratch, exist_ok=True)
+    log.info('Agent with {} slots listening at {}:{}'.format(
+        server.slots, *server.server_address[:2]))
+    with server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def _run(command, cwd, env, timeout):
+    try:
+        process = subprocess.run(
+            command, cwd=cwd, env=env, stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout
+        )
+    except subprocess.TimeoutExpired:
+        return -1, 'Timed out after {} seconds'.format(timeout)
+    except OSError as exc:
+        return 127, str(exc)
+    return process.returncode, process.stdout.decode(errors='ignore')
+
+
+def _receive(reader, path, size, mode):
+    """Write the next size bytes of the reader to the path."""
+    temporary = '{}.{}.tmp'.format(path, threading.get_ident())
+    with open(temporary, 'wb') as file:
+        while size > 0:
+            data = reader.read(min(size, content.CHUNK))
+            if not data:
+                raise ConnectionError('Connection closed while receiving')
+            file.write(data)
+            size -= len(data)
+    os.chmod(temporary, mode)
+    os.replace(temporary, path)
+
+
+def _relative(path, root):
+    """Return the path relative to the root if it is inside, or None."""
+    path = os.path.normpath(path)
+    if path == root:
+        return os.curdir
+    elif path.startswith(os.path.join(root, '')):
+        return path[len(root) + 1:]
+    return None
+
+
+def _rewrite(argument, root):
+    """Make the paths into the root in the argument relative."""
+    if argument.endswith(root):
+        argument = argument[:-len(root)] + os.curdir
+    return argument.replace(os.path.join(root, ''), '')
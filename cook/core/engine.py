@@ -0,0 +1,148 @@
+"""Execution of tasks on a single asyncio event loop.
+
+Instead of dedicating a thread to every job, the engine runs all
+requested commands as asynchronous subprocesses. Only the Python code
+of the rules themselves is run on a small pool of threads, so commands
+yielded with core.command() do not occupy a thread while running.
+
+Rules that call core.call() directly keep working, but block one of the
+pool threads until the process is done, just like a regular worker.
+"""
+
+import asyncio
+import concurrent.futures
+import os
+import subprocess
+import threading
+import time
+
+from . import events, jobserver, log, metrics, misc
+
+
+class Engine(threading.Thread):
+    def __init__(self, jobs, todo, done, slots):
+        super().__init__()
+        self.daemon = True
+        self.jobs = jobs
+        self.todo = todo
+        self.done = done
+        self.loop = asyncio.new_event_loop()
+        # The rules only run Python code on these threads, so there is no
+        # point in having more of them than cores.
+        self.threads = concurrent.futures.ThreadPoolExecutor(
+            min(jobs, os.cpu_count() or 1))
+        # The slots are shared with the workers of agents.
+        self.available = slots
+        self.slots = list(range(jobs))
+
+    def run(self):
+        feeder = threading.Thread(target=self.feed)
+        feeder.daemon = True
+        feeder.start()
+        self.loop.run_forever()
+        self.loop.close()
+
+    def feed(self):
+        while True:
+            # A slot must not be held while waiting for a task, because the
+            # slots are shared with the workers of agents. So at most one
+            # task waits here for a slot, like on every worker.
+            _, _, task = self.todo.get()
+            if task is None:
+                # Wait for the running tasks, which release their slots.
+                for _ in range(self.jobs):
+                    self.available.acquire()
+                for _ in range(self.jobs):
+                    self.available.release()
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self.threads.shutdown(wait=False)
+                return
+            self.available.acquire()
+            token = jobserver.acquire()
+            self.loop.call_soon_threadsafe(self.dispatch, task, token)
+
+    def dispatch(self, task, token):
+        slot = self.slots.pop()
+
+        def release(_):
+            jobserver.release(token)
+            self.slots.append(slot)
+            self.available.release()
+
+        self.loop.create_task(self.work(slot, task)).add_done_callback(
+            release)
+
+    async def work(self, slot, task):
+        events.on_start(slot, task)
+        start = time.perf_counter()
+        lane = slot + 1
+        try:
+            with metrics.traced(task.message, lane, task):
+                with metrics.traced('prepare', lane):
+                    await self.loop.run_in_executor(self.threads, task.prepare)
+                with metrics.traced('execute', lane):
+                    deposits = await self.execute(task)
+                with metrics.traced('finalize', lane):
+                    await self.loop.run_in_executor(
+                        self.threads, task.finalize)
+                    digest = await self.loop.run_in_executor(
+                        self.threads, task.digest)
+        except Exception as exc:
+            self.done.put((task, exc, None, None))
+        else:
+            task.duration = time.perf_counter() - start
+            self.done.put((task, None, deposits, digest))
+
+    async def execute(self, task):
+        steps = task.run()
+        step = steps.send
+        value = None
+        while True:
+            finished, command = await self.loop.run_in_executor(
+                self.threads, advance, step, value)
+            if finished:
+                return command
+            try:
+                value = await call(command)
+            except misc.CallError as exc:
+                step, value = steps.throw, exc
+            else:
+                step = steps.send
+
+
+def advance(step, value):
+    # StopIteration can not be passed through futures.
+    try:
+        return False, step(value)
+    except StopIteration as stop:
+        return True, stop.value
+
+
+async def call(command):
+    """Run the command asynchronously - see misc.call()."""
+    log.debug('CALL {}'.format(subprocess.list2cmdline(command.command)))
+
+    env, fds = jobserver.environment(command.env)
+    metrics.count('spawns')
+
+    process = await asyncio.create_subprocess_exec(
+        *command.command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        stdin=subprocess.DEVNULL, env=env, cwd=command.cwd, pass_fds=fds,
+        **misc.NEW_PROCESS_GROUP
+    )
+    misc.track(process)
+    try:
+        output, _ = await asyncio.wait_for(
+            process.communicate(), command.timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise subprocess.TimeoutExpired(
+            command.command, command.timeout) from None
+    finally:
+        misc.untrack(process)
+
+    output = output.decode(errors='ignore')
+    if process.returncode:
+        raise misc.CallError(process.returncode, command.command, output)
+    return output
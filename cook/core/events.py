@@ -30,10 +30,18 @@ def on_fail(task, exc):
     pass
 
 
+def on_skip(task):
+    pass
+
+
 def on_outdated(count):
     pass
 
 
+def on_estimated(durations):
+    pass
+
+
 def on_jobs(count):
     pass
 
@@ -0,0 +1,118 @@
+"""Cached access to the metadata of files.
+
+All lookups of the build system go through this module, so that every
+path is only stat'ed once per run. Lookups for many files at once can
+be grouped with prefetch(), which spreads the involved directories over
+a pool of threads. On Windows, each directory is listed with a single
+os.scandir(), which already contains the metadata. Elsewhere, scandir()
+would still need a stat() per entry on top of reading the directory, so
+the files are stat'ed individually.
+
+The cache has to be invalidated explicitly whenever a file is known to
+have changed, for example after a task has written its outputs.
+"""
+
+import concurrent.futures
+import os
+import stat as _stat
+import threading
+
+# Maximum number of directories which are scanned concurrently.
+THREADS = 16
+
+cache = {}
+calls = 0
+scans = 0
+lock = threading.Lock()
+
+
+def stat(path):
+    """Return the os.stat_result of the path or None if it is missing."""
+    try:
+        return cache[path]
+    except KeyError:
+        return refresh(path)
+
+
+def refresh(path):
+    """Bypass the cache, but update it with the current metadata."""
+    global calls
+    with lock:
+        calls += 1
+    try:
+        result = os.stat(path)
+    except OSError:
+        result = None
+    cache[path] = result
+    return result
+
+
+def invalidate(path):
+    cache.pop(path, None)
+
+
+def clear():
+    cache.clear()
+
+
+def isfile(path):
+    result = stat(path)
+    return result is not None and _stat.S_ISREG(result.st_mode)
+
+
+def isdir(path):
+    result = stat(path)
+    return result is not None and _stat.S_ISDIR(result.st_mode)
+
+
+def prefetch(paths):
+    """Fill the cache for all given paths which are not yet known."""
+    directories = {}
+    for path in paths:
+        if path not in cache:
+            directory, name = os.path.split(path)
+            directories.setdefault(directory, set()).add(name)
+
+    if len(directories) < 2:
+        for directory, names in directories.items():
+            _scan(directory, names)
+        return
+
+    workers = min(THREADS, len(directories))
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        for directory, names in directories.items():
+            executor.submit(_scan, directory, names)
+
+
+def _scan(directory, names):
+    global calls, scans
+    if os.name != 'nt':
+        for name in names:
+            refresh(os.path.join(directory, name))
+        return
+
+    with lock:
+        scans += 1
+    try:
+        entries = os.scandir(directory)
+    except FileNotFoundError:
+        for name in names:
+            cache[os.path.join(directory, name)] = None
+        return
+    except OSError:
+        for name in names:
+            refresh(os.path.join(directory, name))
+        return
+
+    with entries:
+        for entry in entries:
+            if entry.name in names:
+                names.discard(entry.name)
+                with lock:
+                    calls += 1
+                try:
+                    cache[entry.path] = entry.stat()
+                except OSError:
+                    cache[entry.path] = None
+    for name in names:
+        cache[os.path.join(directory, name)] = None
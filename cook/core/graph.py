@@ -1,17 +1,30 @@
 import os
 import stat
+import sys
 import types
 
-from . import misc, record
+from . import (
+    artifacts, content, fs, loader, log, metrics, misc, pool, record
+)
 
 paths = {}
-stats = 0
 tasks = set()
+frames = {}
+frozen = False
+
+# Results of the tasks spawned by the rules which are currently running up
+# to their publication, and the recorded ones while a task is restarted.
+spawning = []
+replaying = None
 
 
 class File:
+    __slots__ = (
+        'path', 'producer', 'dependants', 'timestamp', 'exists', 'phony'
+    )
+
     def __init__(self, path):
-        self.path = path
+        self.path = sys.intern(str(path))
         self.producer = None
         self.dependants = set()
         self.timestamp = None
@@ -19,56 +32,73 @@ class File:
         self.phony = False
 
     def changed(self):
-        return self.timestamp != os.path.getmtime(self.path)
+        current = fs.refresh(self.path)
+        return current is None or self.timestamp != current.st_mtime
 
     def __repr__(self):
         return '<Produced File>' if self.producer else '<File>'
 
     def stat(self):
-        global stats
-        stats += 1
-        try:
-            st = os.stat(self.path)
-        except OSError:
+        st = fs.stat(self.path)
+        if st is not None and stat.S_ISREG(st.st_mode):
+            self.exists = True
+            self.timestamp = st.st_mtime
+        else:
             self.exists = False
             self.timestamp = None
-        else:
-            if stat.S_ISREG(st.st_mode):
-                self.exists = True
-                self.timestamp = st.st_mtime
-            else:
-                self.exists = False
-                self.timestamp = None
 
     def stat_if_necessary(self):
         if self.exists is None:
             return self.stat()
         return False
 
+    def fingerprint(self):
+        """Return the digest of the contents if enabled or the timestamp."""
+        if content.enabled and self.exists:
+            return content.digest(self.path)
+        return self.timestamp
+
 
 class Task:
-    def __init__(self, generator, message, check, force, phony, stack):
+    __slots__ = (
+        'generator', 'message', 'check', 'force', 'phony', 'pool', 'weight',
+        'result', 'inputs', 'outputs', 'primary', 'secondary', 'deposits',
+        'warnings', 'duration', 'stack', 'rule', 'directory', 'children',
+        'identity'
+    )
+
+    def __init__(
+        self, generator, message, check, force, phony, pool, weight, stack
+    ):
         self.generator = generator
         self.message = message
         self.check = check
         self.force = force
         self.phony = phony
+        self.pool = pool
+        self.weight = weight
         self.result = None
 
         self.inputs = set()
         self.outputs = set()
         self.primary = None
         self.secondary = None
-        self.deposits = set()
+        self.deposits = ()
         self.warnings = None
+        self.duration = None
         self.stack = stack
+        self.rule = None
+        self.directory = None
+        self.children = ()
+        self.identity = None
 
     def prepare(self):
         if not self.phony:
             for output in self.outputs:
                 dirname = os.path.dirname(output.path)
-                if dirname and not os.path.isdir(dirname):
+                if dirname and not fs.isdir(dirname):
                     os.makedirs(dirname, exist_ok=True)
+                    fs.invalidate(dirname)
         for input in self.inputs:
             if not input.producer and input.changed():
                 raise RuntimeError(
@@ -78,26 +108,90 @@ class Task:
                     .format(input.path)
                 )
 
-    def execute(self):
+    def execute(self, call=None):
+        """Run the rest of the rule on the current thread.
+
+        The commands are run by call(command) if given.
+        """
+        steps = self.run()
         try:
-            deposits = next(self.generator)
+            command = next(steps)
+            while True:
+                try:
+                    if call is None:
+                        output = command.call()
+                    else:
+                        output = call(command)
+                except misc.CallError as exc:
+                    command = steps.throw(exc)
+                else:
+                    command = steps.send(output)
+        except StopIteration as stop:
+            return stop.value
+
+    def run(self):
+        """Drive the rule and yield every command it requests.
+
+        The output of each command must be sent back, or an exception
+        thrown in if it failed. The deposits are returned at the end.
+        """
+        # The generator can not be resumed after a failure, so it is
+        # dropped in any case. restart() creates a new one if necessary.
+        generator, self.generator = self.generator, None
+        key = artifacts.key(self)
+        if key is not None:
+            deposits = artifacts.restore(self, key)
+            if deposits is not None:
+                generator.close()
+                return deposits
+        try:
+            deposits = next(generator)
+            while isinstance(deposits, misc.Command):
+                try:
+                    output = yield deposits
+                except misc.CallError as exc:
+                    deposits = generator.throw(exc)
+                else:
+                    deposits = generator.send(output)
         except StopIteration:
             deposits = set(), None
         else:
+            if isinstance(deposits, pool.Offload):
+                deposits = pool.run(deposits) or (set(), None)
             try:
-                next(self.generator)
+                next(generator)
             except StopIteration:
                 pass
             else:
                 raise RuntimeError(
-                    'Task is not exhausted after second yield\n\n'
-                    'It is required that the generator yields at most two '
-                    'time - once for the publication, once for the '
-                    'deposit. Then it must be done.'
+                    'Task is not exhausted after the deposit\n\n'
+                    'It is required that the generator yields once for the '
+                    'publication, then any number of commands and at most '
+                    'once for the deposit or offload. Then it must be done.'
                 )
-        self.generator = None
+        if key is not None:
+            artifacts.store(self, key, deposits)
         return deposits
 
+    def restart(self):
+        """Invoke the rule again up to its publication.
+
+        This is used to run a task which was already executed once. The
+        tasks spawned by the rule are not spawned again - their recorded
+        results are returned instead and the publication is ignored.
+        """
+        global replaying
+        func, args, kwargs = self.rule
+        loader.directories.append(self.directory)
+        replaying = iter(self.children)
+        try:
+            generator = func(*args, **kwargs)
+            next(generator)
+        finally:
+            replaying = None
+            loader.directories.pop()
+        self.generator = generator
+
     def finalize(self):
         for input in self.inputs:
             if not input.producer and input.changed():
@@ -111,6 +205,7 @@ class Task:
         if not self.phony:
             for output in self.outputs:
                 previous = output.timestamp
+                fs.invalidate(output.path)
                 output.stat()
                 if not output.exists:
                     raise RuntimeError(
@@ -136,7 +231,7 @@ class Task:
         for file in self.inputs:
             if file.producer is None:
                 file.stat_if_necessary()
-                timestamps.add(file.timestamp)
+                timestamps.add(file.fingerprint())
 
         self.primary = misc.checksum(inputs, timestamps, outputs, self.check)
 
@@ -146,7 +241,7 @@ class Task:
         for file in self.outputs:
             file.stat_if_necessary()
             if file.exists:
-                out_times.add(file.timestamp)
+                out_times.add(file.fingerprint())
             else:
                 out_times.add(-1)
 
@@ -158,19 +253,30 @@ class Task:
         for file in self.deposits:
             file.stat_if_necessary()
             if file.exists:
-                deposit_times.add(os.path.getmtime(file.path))
+                deposit_times.add(file.fingerprint())
             else:
                 deposit_times.add(-1)
 
         # Save the new checksum and deposits to the record file.
         self.secondary = misc.checksum(out_times, deposit_times)
 
+    def digest(self):
+        """Return a digest of the contents of all outputs.
+
+        None is returned if no task depends on the outputs, since the
+        digest is only needed to skip the dependants.
+        """
+        if self.phony or not any(file.dependants for file in self.outputs):
+            return None
+        return misc.checksum(sorted(
+            (file.path, content.digest(file.path)) for file in self.outputs))
+
     def is_dirty(self):
         if self.force:
             return True
         elif not record.has_primary(self.primary):
             return True
-        elif not self.phony and not all(os.path.isfile(file.path)
+        elif not self.phony and not all(fs.isfile(file.path)
                                         for file in self.outputs):
             return True
         else:
@@ -181,42 +287,172 @@ class Task:
                 return False
 
 
-def all_parent_tasks(tasks):
-    stack = list(tasks)
-    parents = set(stack)
-
-    for task in stack:
-        for file in task.inputs:
-            producer = file.producer
-            if producer is not None and producer not in parents:
-                stack.append(producer)
-                parents.add(producer)
-    return parents
+def freeze():
+    """Replace the edge sets of all files and tasks by tuples.
+
+    This saves a considerable amount of memory for large graphs, but no
+    further tasks can be spawned afterwards.
+    """
+    global frozen
+    if frozen:
+        return
+    for file in paths.values():
+        file.dependants = tuple(file.dependants)
+    for task in tasks:
+        task.inputs = tuple(task.inputs)
+        task.outputs = tuple(task.outputs)
+    frozen = True
+
+
+def compact_stack(frame):
+    """Return the stack leading to the frame as (file, line, name) tuples.
+
+    Equal entries are shared between all stacks and the source lines are
+    only looked up once they are formatted.
+    """
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        entry = (code.co_filename, frame.f_lineno, code.co_name)
+        stack.append(frames.setdefault(entry, entry))
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
+
+
+def sorted_parent_tasks(tasks):
+    """Return the tasks and all their parents in topological order.
+
+    Every task is placed after the producers of all of its inputs.
+    """
+    order = []
+    visited = set()
+    for root in tasks:
+        if root in visited:
+            continue
+        # Iterative post-order traversal to support very deep graphs.
+        visited.add(root)
+        stack = [(root, iter(root.inputs))]
+        while stack:
+            task, inputs = stack[-1]
+            for file in inputs:
+                producer = file.producer
+                if producer is not None and producer not in visited:
+                    visited.add(producer)
+                    stack.append((producer, iter(producer.inputs)))
+                    break
+            else:
+                stack.pop()
+                order.append(task)
+    return order
 
 
 def all_outdated_tasks_for(files):
-    parents = all_parent_tasks(file.producer for file in files)
-
-    # log.debug('Calculating secondary')
-    # for task in parents:
-    #     task.calculate_secondary()
-
-    # log.debug('Calculating dirtyness')
-    stack = [task for task in parents if task.is_dirty()]
-
-    # log.debug('Propagating dirtyness')
-    outdated = set(stack)
-    while stack:
-        task = stack.pop()
-        for output in task.outputs:
-            for dependant in output.dependants:
-                if dependant not in outdated and dependant in parents:
-                    outdated.add(dependant)
-                    stack.append(dependant)
+    """Return all tasks which must be run to bring the files up-to-date.
+
+    The graph is traversed once in topological order. A task whose inputs
+    are produced by an outdated task is outdated as well, so the rather
+    expensive Task.is_dirty() is only called if that is not the case.
+    """
+    with metrics.timed('dirty'):
+        parents = sorted_parent_tasks(
+            file.producer for file in files if file.producer is not None)
+        outdated = set()
+        checked = 0
+        for task in parents:
+            if any(file.producer in outdated for file in task.inputs):
+                outdated.add(task)
+            else:
+                checked += 1
+                if task.is_dirty():
+                    outdated.add(task)
+
+    log.debug('Checked {} of {} tasks, {} are outdated ({:.3f}s).'.format(
+        checked, len(parents), len(outdated), metrics.timings['dirty']))
     return outdated
 
 
+def estimate_durations(tasks):
+    """Estimate the execution time of the given tasks in seconds.
+
+    The smoothed durations of earlier runs are used where available.
+    Tasks without any history are assumed to take the average of the
+    known ones. If nothing is known at all, None is returned.
+    """
+    durations = {}
+    unknown = []
+    for task in tasks:
+        duration = record.get_estimate(task)
+        if duration is None:
+            unknown.append(task)
+        else:
+            durations[task] = duration
+
+    if not durations:
+        return None
+    average = sum(durations.values()) / len(durations)
+    for task in unknown:
+        durations[task] = average
+    return durations
+
+
+def critical_paths(tasks, costs=None):
+    """Return the longest remaining path for each of the given tasks.
+
+    Only paths inside of 'tasks' are considered. The length of a path
+    is the sum of the costs of the tasks on it, including the first one.
+    Tasks with a longer path should be started first, since they limit
+    the total duration of the build. If no costs are given, the fan-out
+    of each task is used as an approximation.
+    """
+    if costs is None:
+        costs = {task: 1 + sum(len(output.dependants)
+                               for output in task.outputs) for task in tasks}
+
+    lengths = {}
+    for root in tasks:
+        if root in lengths:
+            continue
+        # Iterative post-order traversal to support very deep graphs.
+        stack = [(root, False)]
+        while stack:
+            task, expanded = stack.pop()
+            if task in lengths:
+                continue
+            dependants = [
+                dependant for output in task.outputs
+                for dependant in output.dependants if dependant in tasks
+            ]
+            if expanded:
+                lengths[task] = costs[task] + max(
+                    (lengths[dependant] for dependant in dependants),
+                    default=0
+                )
+            else:
+                stack.append((task, True))
+                stack.extend((dependant, False) for dependant in dependants
+                             if dependant not in lengths)
+    return lengths
+
+
 def spawn_task(func, *args, **kwargs):
+    if replaying is not None:
+        try:
+            return next(replaying)
+        except StopIteration:
+            raise RuntimeError(
+                'Rule spawned more tasks than in its first invocation\n\n'
+                'Rules must spawn the same tasks every time they are invoked '
+                'with the same arguments.'
+            ) from None
+
+    if frozen:
+        raise RuntimeError(
+            'Tasks can not be spawned while building\n\n'
+            'All tasks must be created while the build scripts are loaded. '
+            'Rules can not spawn new tasks after their publication.'
+        )
+
     generator = func(*args, **kwargs)
 
     if not isinstance(generator, types.GeneratorType):
@@ -229,6 +465,7 @@ def spawn_task(func, *args, **kwargs):
             'calling context. Maybe \'yield\' in front of core.publish() is '
             'missing.'
         )
+    spawning.append([])
     try:
         publication = next(generator)
     except StopIteration:
@@ -239,8 +476,10 @@ def spawn_task(func, *args, **kwargs):
             'anything. This was most-likely caused by incomplete if/elif '
             'branching of the rule defintion and not by the calling context.'
         ) from None
+    finally:
+        children = spawning.pop()
 
-    if not isinstance(publication, tuple) or not len(publication) == 8:
+    if not isinstance(publication, tuple) or not len(publication) == 10:
         raise ValueError(
             'Rule did yield something, but not a publication\n\n'
             'Every rule must first yield the result of a core.publish() call. '
@@ -248,8 +487,12 @@ def spawn_task(func, *args, **kwargs):
             'calling context.'
         )
 
-    inputs, message, outputs, check, force, result, phony, stack = publication
-    task = Task(generator, message, check, force, phony, stack)
+    (inputs, message, outputs, check, force, result, phony, pool, weight,
+     stack) = publication
+    task = Task(generator, message, check, force, phony, pool, weight, stack)
+    task.rule = (func, args, kwargs)
+    task.directory = loader.directories[-1]
+    task.children = tuple(children)
 
     for input in inputs:
         task.inputs.add(input)
@@ -263,6 +506,8 @@ def spawn_task(func, *args, **kwargs):
     task.result._task = task
 
     tasks.add(task)
+    if spawning:
+        spawning[-1].append(task.result)
 
     # task.calculate_primary()
     #
@@ -0,0 +1,178 @@
+"""Support for the GNU make jobserver protocol.
+
+A jobserver is a pipe or named FIFO filled with one byte per available
+job slot. Every process in the tree takes a byte before starting a job
+and writes it back afterwards. Additionally, every process owns one
+implicit slot for which no byte is needed.
+
+If the environment advertises a jobserver (e.g. because cook was started
+by "make -j"), cook acts as a client. Otherwise, it creates a jobserver
+itself, which is passed on to all processes started by core.call().
+Both the pipe ("R,W") and the FIFO ("fifo:PATH") variants are supported.
+"""
+
+import os
+import re
+import select
+import tempfile
+import threading
+
+from . import log
+
+TOKEN = b'+'
+
+reader = None
+writer = None
+makeflags = None
+inherited = ()
+opened = ()
+fifo = None
+implicit = True
+lock = threading.Lock()
+
+
+def parse(flags):
+    """Return the advertised jobserver as ('fifo', path) or ('pipe', fds)."""
+    if not flags:
+        return None
+    match = None
+    for match in re.finditer(
+            r'--jobserver-(?:auth|fds)=(fifo:(\S+)|(\d+),(\d+))', flags):
+        pass
+    if match is None:
+        return None
+    elif match.group(2) is not None:
+        return 'fifo', match.group(2)
+    else:
+        return 'pipe', (int(match.group(3)), int(match.group(4)))
+
+
+def connect(flags):
+    """Act as a client of the advertised jobserver.
+
+    Returns True if the jobserver is usable.
+    """
+    global reader, writer, makeflags, inherited, opened
+
+    advertised = parse(flags)
+    if advertised is None:
+        return False
+    kind, location = advertised
+
+    if kind == 'fifo':
+        try:
+            reader = writer = os.open(location, os.O_RDWR | os.O_NONBLOCK)
+        except OSError as exc:
+            log.warning('Could not open jobserver FIFO: {}'.format(exc))
+            return False
+        opened = (reader,)
+    else:
+        # The descriptors are closed if the parent did not mark us as a
+        # recursive invocation (e.g. with a leading "+" in a Makefile).
+        try:
+            for fd in location:
+                os.fstat(fd)
+        except OSError:
+            log.warning('Jobserver is advertised but not available - '
+                        'is the invocation marked as recursive?')
+            return False
+        reader, writer = location
+        inherited = location
+
+    makeflags = flags
+    log.debug('Using jobserver {}'.format(location))
+    return True
+
+
+def serve(jobs, style='pipe'):
+    """Act as a jobserver with the given number of slots for the tree."""
+    global reader, writer, makeflags, inherited, opened, fifo
+
+    if style == 'fifo':
+        fifo = os.path.join(tempfile.mkdtemp(prefix='cook-'), 'jobserver')
+        os.mkfifo(fifo, 0o600)
+        reader = writer = os.open(fifo, os.O_RDWR | os.O_NONBLOCK)
+        opened = (reader,)
+        auth = 'fifo:' + fifo
+    elif style == 'pipe':
+        reader, writer = os.pipe()
+        os.set_inheritable(reader, True)
+        os.set_inheritable(writer, True)
+        inherited = opened = (reader, writer)
+        auth = '{},{}'.format(reader, writer)
+    else:
+        raise ValueError('unknown jobserver style: {}'.format(style))
+
+    os.write(writer, TOKEN * (jobs - 1))
+    makeflags = ' -j{} --jobserver-auth={}'.format(jobs, auth)
+    log.debug('Serving jobserver {} with {} slots'.format(auth, jobs))
+
+
+def start(jobs, style=None):
+    """Connect to an advertised jobserver or serve one if there is none.
+
+    The style may be 'fifo', 'pipe' or 'none'. By default, a pipe is
+    used, since FIFOs are only understood by GNU make 4.4 and newer.
+    """
+    if style == 'none' or os.name == 'nt':
+        return
+    if connect(os.environ.get('MAKEFLAGS')):
+        return
+    if jobs > 1:
+        serve(jobs, style or 'pipe')
+
+
+def stop():
+    global reader, writer, makeflags, inherited, opened, fifo, implicit
+    for fd in opened:
+        os.close(fd)
+    if fifo is not None:
+        os.remove(fifo)
+        os.rmdir(os.path.dirname(fifo))
+    reader = writer = makeflags = fifo = None
+    inherited = opened = ()
+    implicit = True
+
+
+def acquire():
+    """Block until a job slot is available and return its token.
+
+    The implicit slot is represented by None.
+    """
+    global implicit
+    while True:
+        with lock:
+            if implicit or reader is None:
+                implicit = False
+                return None
+        # Wake up regularly in order to notice a released implicit slot.
+        readable, _, _ = select.select([reader], [], [], 0.1)
+        if readable:
+            try:
+                token = os.read(reader, 1)
+            except (BlockingIOError, InterruptedError):
+                continue
+            if token:
+                return token
+
+
+def release(token):
+    """Give a slot obtained by acquire() back."""
+    global implicit
+    if token is None:
+        with lock:
+            implicit = True
+    elif writer is not None:
+        os.write(writer, token)
+
+
+def environment(env):
+    """Return the environment and descriptors for a child process.
+
+    None stands for the environment of this process.
+    """
+    if makeflags is None:
+        return env, inherited
+    env = dict(os.environ if env is None else env)
+    env['MAKEFLAGS'] = makeflags
+    return env, inherited
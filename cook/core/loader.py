@@ -3,16 +3,28 @@
 Any build script can make use of this module by loading other scripts,
 allowing the existence of hierarchy and separation of concerns. Paths
 may be interpreted relatively to the script that is being executed.
+
+Compiled scripts are kept in .cook/bytecode.marshal together with the
+digest of their source, like __pycache__ does for modules, and are only
+compiled again if their source changed or another Python version runs.
 """
 
+import hashlib
+import importlib.util
+import marshal
+import os
 from os.path import normpath, relpath, join, abspath, isdir, isfile, dirname
 
-from . import events, log, misc
+from . import events, log, metrics, misc, system
 
 loaded = {}
 executing = set()
 directories = ['.']
 
+# Code objects by the path of their script, with the digest of its source.
+compiled = None
+recompiled = False
+
 
 def resolve(path_or_paths):
     """Interpret given paths relative to the current script directory.
@@ -69,8 +81,15 @@ def load(path):
 
     with open(path) as f:
         content = f.read()
+    digest = hashlib.blake2b(
+        content.encode(errors='surrogatepass'), digest_size=16).digest()
+    code = _cached(path, digest)
+    if code is None:
+        code = compile(content, path, 'exec')
+        _store(path, digest, code)
     symbols = {'__file__': path}
-    exec(compile(content, path, 'exec'), symbols)
+    with metrics.traced('Load ' + path, 0):
+        exec(code, symbols)
 
     directories.pop()
     executing.remove(path)
@@ -81,6 +100,58 @@ def load(path):
     return namespace
 
 
+def save():
+    """Write the compiled scripts if any of them was compiled again.
+
+    Scripts are compiled before they are executed, so they are also kept
+    if loading failed.
+    """
+    global recompiled
+    if not recompiled or system.build_dir is None:
+        return
+    # Scripts which do not exist anymore are forgotten.
+    entries = {path: entry for path, entry in compiled.items()
+               if isfile(path)}
+    path = system.build('.cook/bytecode.marshal')
+    with open(path + '.tmp', 'wb') as file:
+        # The magic number is written as a raw header, because code objects
+        # of other Python versions must not be unmarshalled at all.
+        file.write(importlib.util.MAGIC_NUMBER)
+        marshal.dump(entries, file)
+    os.replace(path + '.tmp', path)
+    recompiled = False
+
+
+def _cached(path, digest):
+    """Return the compiled script if its source did not change."""
+    global compiled
+    if compiled is None:
+        compiled = {}
+        if system.build_dir is not None:
+            magic = importlib.util.MAGIC_NUMBER
+            try:
+                with open(system.build('.cook/bytecode.marshal'), 'rb') as f:
+                    if f.read(len(magic)) == magic:
+                        entries = marshal.load(f)
+                        if isinstance(entries, dict):
+                            compiled = entries
+            except FileNotFoundError:
+                pass
+            except Exception as exc:
+                # Broken data may raise anything while being unmarshalled.
+                log.debug('Ignoring the compiled scripts: {}'.format(exc))
+    entry = compiled.get(path)
+    if entry is not None and entry[0] == digest:
+        return entry[1]
+    return None
+
+
+def _store(path, digest, code):
+    global recompiled
+    compiled[path] = digest, code
+    recompiled = True
+
+
 class Script:
     def __init__(self, path, symbols):
         self.__path = path
@@ -0,0 +1,167 @@
+"""Measurements of the overhead of the build system itself.
+
+Besides the accumulated wall time per phase and a few counters, which
+are summarized by report(), a timeline can be recorded in the trace
+event format of Chrome, which is shown by chrome://tracing and Perfetto.
+Lane 0 is the main thread, while the jobs use the lanes from 1 on.
+Nothing is recorded unless tracing was started.
+"""
+
+import collections
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from . import fs
+
+# Phases in the order in which they happen. Scheduling is part of the
+# execution and only measures the handling of finished tasks.
+PHASES = ('load', 'primaries', 'record', 'dirty', 'execution', 'schedule',
+          'clean')
+
+timings = {}
+counters = collections.Counter()
+# Counters which are expensive to maintain are only kept if enabled.
+counting = False
+children = 0.0
+trace = None
+origin = time.perf_counter()
+lock = threading.Lock()
+
+
+def count(name, amount=1):
+    with lock:
+        counters[name] += amount
+
+
+def reset():
+    """Start the measurements of another build of the same process."""
+    global children
+    timings.clear()
+    counters.clear()
+    fs.calls = fs.scans = 0
+    children = _children()
+
+
+def report(tasks):
+    """Return a summary of the measurements of the build of the tasks."""
+    lines = ['Phases:']
+    for phase in PHASES + tuple(sorted(set(timings) - set(PHASES))):
+        if phase in timings:
+            lines.append('  {:<12}{:>10.3f} s'.format(phase, timings[phase]))
+    rules = collections.Counter(
+        '{}.{}'.format(task.rule[0].__module__, task.rule[0].__qualname__)
+        for task in tasks if task.rule is not None)
+    lines.append('Tasks: {}'.format(len(tasks)))
+    for rule, number in sorted(rules.items(), key=lambda item: -item[1]):
+        lines.append('  {:<40}{:>8}'.format(rule, number))
+    lines.append('File system: {} stat calls, {} directory scans'.format(
+        fs.calls, fs.scans))
+    lines.append('Checksums: {} calls, {:.1f} MB hashed'.format(
+        counters['checksums'], counters['hashed'] / 1e6))
+    lines.append('Processes: {} spawned, {:.2f} s CPU time'.format(
+        counters['spawns'], _children() - children))
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes.
+        if sys.platform != 'darwin':
+            peak *= 1024
+        lines.append('Peak memory: {:.1f} MB'.format(peak / 1e6))
+    return '\n'.join(lines)
+
+
+def _children():
+    """Return the CPU time of all terminated child processes."""
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+@contextlib.contextmanager
+def timed(phase, name=None, **args):
+    """Add the wall time spent inside of the block to the given phase.
+
+    If tracing, the block is also added to the main lane of the timeline
+    under the given name, which defaults to the phase.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(phase, start, name, **args)
+
+
+def add(phase, start, name=None, **args):
+    """Add the wall time since the start to the given phase."""
+    end = time.perf_counter()
+    timings[phase] = timings.get(phase, 0) + end - start
+    if trace is not None:
+        span(name or phase, 0, start, end, args)
+
+
+@contextlib.contextmanager
+def traced(name, lane, task=None):
+    """Add the block to the lane of the timeline, if tracing.
+
+    The outputs of the task are attached to the block.
+    """
+    if trace is None:
+        yield
+        return
+    args = {}
+    if task is not None:
+        args['outputs'] = sorted(file.path for file in task.outputs)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        span(name, lane, start, time.perf_counter(), args)
+
+
+def span(name, lane, start, end, args):
+    event = {
+        'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': lane,
+        'ts': (start - origin) * 1e6, 'dur': (end - start) * 1e6,
+    }
+    if args:
+        event['args'] = args
+    with lock:
+        trace.append(event)
+
+
+def start_trace():
+    """Record a timeline from now on."""
+    global trace
+    if trace is None:
+        trace = []
+
+
+def stop_trace():
+    """Discard the timeline and stop recording it."""
+    global trace
+    trace = None
+
+
+def write_trace(path):
+    """Write the recorded timeline to the path and start a new one."""
+    global trace
+    with lock:
+        recorded, trace = trace, []
+    lanes = sorted({event['tid'] for event in recorded} | {0})
+    names = [{
+        'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': lane,
+        'args': {'name': 'Job {}'.format(lane - 1) if lane else 'Main'}
+    } for lane in lanes]
+    with open(path, 'w') as file:
+        json.dump({
+            'traceEvents': names + recorded, 'displayTimeUnit': 'ms'
+        }, file)
@@ -1,14 +1,16 @@
+import array
 import glob as _glob
 import hashlib
 import os
 import platform
 import random as _random
+import signal
 import struct
 import subprocess
 import sys
 import threading
 
-from . import log
+from . import jobserver, log, metrics, probes
 
 system = platform.system()
 linux = system == 'Linux'
@@ -20,6 +22,11 @@ if windows:
 else:
     NEW_PROCESS_GROUP = dict(preexec_fn=os.setpgrp)
 
+# Processes started by the builder, which are terminated on an abort.
+running = set()
+running_lock = threading.Lock()
+terminating = False
+
 
 class Marked(str):
     pass
@@ -45,7 +52,7 @@ def cache(func):
 
 
 def checksum(*objects):
-    """Calculate an MD5-checksum (128 bits) of the given object.
+    """Calculate a checksum (128 bits) of the given object.
 
     The types of the object and it's elements (in case of a container)
     may only consist of:
@@ -56,20 +63,283 @@ def checksum(*objects):
     - bytes, bytearray, ...
     - dict, ...
     - set, frozenset, ...
-    - list, tuple, generator, ...
-
-    A TypeError will be raised if an unsupported type is encountered.
+    - list, tuple, ...
 
-    Please note that cyclic containers lead to an exceeding of the
-    maximum recursion depth, which raises to a RuntimeError.
+    A TypeError will be raised if an unsupported type is encountered and
+    a RuntimeError if a container contains itself.
 
     The builtin hash-function cannot be used, since it is randomized
     for strings, bytes and datetime objects and sometimes even slower
     when trying to get a byte representation.
+
+    The objects are encoded without recursion and hashed with BLAKE2b.
+    Tuples and frozensets with at least SHARED elements are replaced by
+    their own digest, which is cached as long as they only consist of
+    immutable values, since they are often shared between many tasks.
+    Sets and dicts are canonicalised by sorting the encodings of their
+    elements, so that their elements do not have to be comparable. In
+    compatible mode, the MD5-checksums of earlier versions are used.
+    """
+    if compatible:
+        hasher = hashlib.md5()
+        if metrics.counting:
+            counted = _Counted(hasher)
+            _checksum(counted, objects)
+            metrics.count('checksums')
+            metrics.count('hashed', counted.size)
+        else:
+            _checksum(hasher, objects)
+        return hasher.hexdigest()
+
+    parts = [_pack(_LIST, len(objects))]
+    _encode(list(reversed(objects)), parts, set())
+    data = b''.join(parts)
+    if metrics.counting:
+        metrics.count('checksums')
+        metrics.count('hashed', len(data))
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+# Tuples and frozensets with at least this many elements are hashed on
+# their own.
+SHARED = 8
+
+# The cache of sub-digests is cleared once it has this many entries.
+CACHED = 100000
+
+_STR = b'\x00'
+_TRUE = b'\x01'
+_FALSE = b'\x02'
+_POSITIVE = b'\x03'
+_NEGATIVE = b'\x04'
+_FLOAT = b'\x05'
+_NONE = b'\x06'
+_BYTES = b'\x07'
+_DICT = b'\x08'
+_SET = b'\x09'
+_LIST = b'\x0a'
+_DIGEST = b'\x0c'
+_TEXTS = b'\x0d'
+_TEXT_SET = b'\x0e'
+_FLOATS = b'\x0f'
+_FLOAT_SET = b'\x10'
+_TERMINATED = b'\x11'
+_MEASURED = b'\x12'
+
+_pack = struct.Struct('<cQ').pack
+_float = struct.Struct('<d').pack
+
+# Sub-digests by id(), together with their object which keeps the id
+# from being reused.
+_digests = {}
+
+compatible = False
+
+
+def configure_checksum(compatibility):
+    """Use the MD5-checksums of earlier versions if enabled."""
+    global compatible
+    compatible = compatibility
+
+
+class _Leave:
+    """Marks the end of a container while encoding."""
+
+    __slots__ = ('identity',)
+
+    def __init__(self, identity):
+        self.identity = identity
+
+
+def _encode(stack, parts, active):
+    """Append the encoding of the objects popped from the stack.
+
+    Returns whether all of them are immutable.
     """
-    hasher = hashlib.md5()
-    _checksum(hasher, objects)
-    return hasher.hexdigest()
+    frozen = True
+    while stack:
+        obj = stack.pop()
+        kind = type(obj)
+        if kind is str:
+            data = obj.encode()
+            parts.append(_pack(_STR, len(data)))
+            parts.append(data)
+            continue
+        elif kind is _Leave:
+            active.remove(obj.identity)
+            continue
+        kind = _KINDS.get(kind) or _kind(obj)
+
+        if kind is str:
+            data = obj.encode()
+            parts.append(_pack(_STR, len(data)))
+            parts.append(data)
+        elif kind is bool:
+            parts.append(_TRUE if obj else _FALSE)
+        elif kind is int:
+            tag = _POSITIVE
+            if obj < 0:
+                tag = _NEGATIVE
+                obj = -obj
+            data = obj.to_bytes((obj.bit_length() + 7) // 8 or 1, 'little')
+            parts.append(_pack(tag, len(data)))
+            parts.append(data)
+        elif kind is float:
+            parts.append(_FLOAT + _float(obj))
+        elif kind is _NoneType:
+            parts.append(_NONE)
+        elif kind is bytes or kind is bytearray:
+            frozen = frozen and kind is bytes
+            parts.append(_pack(_BYTES, len(obj)))
+            parts.append(bytes(obj))
+        elif (kind is tuple or kind is frozenset) and len(obj) >= SHARED:
+            digest, immutable = _digest(obj, kind, active)
+            frozen = frozen and immutable
+            parts.append(_DIGEST + digest)
+        else:
+            frozen = _open(obj, kind, parts, stack, active) and frozen
+    return frozen
+
+
+def _open(obj, kind, parts, stack, active):
+    """Append the encoding of a container and push its elements.
+
+    Returns whether the container itself is immutable. Containers whose
+    elements are all strings or all floats are encoded at once.
+    """
+    identity = id(obj)
+    if identity in active:
+        raise RuntimeError('Container contains itself.')
+    sequence = kind is list or kind is tuple
+    immutable = kind is tuple or kind is frozenset
+    elements = obj if sequence else _sorted(obj)
+
+    if kind is dict:
+        if elements is None or not _texts(elements, _DICT, parts):
+            active.add(identity)
+            _elements(obj.items(), _DICT, parts, active)
+            active.remove(identity)
+            return False
+        active.add(identity)
+        stack.append(_Leave(identity))
+        stack.extend([obj[key] for key in reversed(elements)])
+        return False
+    elif elements is not None:
+        if _texts(elements, _TEXTS if sequence else _TEXT_SET, parts):
+            return immutable
+        elif set(map(type, elements)) == {float}:
+            values = array.array('d', elements)
+            if sys.byteorder == 'big':
+                values.byteswap()
+            parts.append(_pack(_FLOATS if sequence else _FLOAT_SET,
+                               len(values)))
+            parts.append(values.tobytes())
+            return immutable
+
+    active.add(identity)
+    if sequence:
+        parts.append(_pack(_LIST, len(obj)))
+        stack.append(_Leave(identity))
+        stack.extend(reversed(obj))
+        return immutable
+    frozen = _elements(obj, _SET, parts, active)
+    active.remove(identity)
+    return frozen and immutable
+
+
+def _sorted(elements):
+    """Return the sorted elements or None if they are not comparable."""
+    try:
+        return sorted(elements)
+    except TypeError:
+        return None
+
+
+def _texts(strings, tag, parts):
+    """Append the encoding of the strings, if all elements are strings.
+
+    Strings without NUL characters are terminated by them, otherwise their
+    lengths are prepended.
+    """
+    try:
+        text = ''.join(strings)
+    except TypeError:
+        return False
+    if '\x00' in text:
+        lengths = array.array('Q', map(len, strings))
+        if sys.byteorder == 'big':
+            lengths.byteswap()
+        parts.append(_pack(tag, len(strings)) + _MEASURED + lengths.tobytes())
+        parts.append(text.encode())
+    else:
+        parts.append(_pack(tag, len(strings)) + _TERMINATED)
+        parts.append('\x00'.join(strings).encode() + b'\x00')
+    return True
+
+
+def _elements(elements, tag, parts, active):
+    """Append the encodings of the elements in sorted order.
+
+    Returns whether all of them are immutable.
+    """
+    frozen = True
+    encodings = []
+    for element in elements:
+        encoded = []
+        frozen = _encode([element], encoded, active) and frozen
+        encodings.append(b''.join(encoded))
+    encodings.sort()
+    parts.append(_pack(tag, len(encodings)))
+    parts.extend(encodings)
+    return frozen
+
+
+def _digest(obj, kind, active):
+    """Return the digest of a tuple or frozenset and if it is immutable."""
+    entry = _digests.get(id(obj))
+    if entry is not None and entry[0] is obj:
+        return entry[1], True
+    parts = []
+    stack = []
+    frozen = _open(obj, kind, parts, stack, active)
+    frozen = _encode(stack, parts, active) and frozen
+    digest = hashlib.blake2b(b''.join(parts), digest_size=16).digest()
+    if frozen:
+        if len(_digests) >= CACHED:
+            _digests.clear()
+        _digests[id(obj)] = obj, digest
+    return digest, frozen
+
+
+_NoneType = type(None)
+
+_KINDS = {
+    kind: kind for kind in (
+        str, bool, int, float, _NoneType, bytes, bytearray, tuple, list, dict,
+        set, frozenset
+    )
+}
+
+
+def _kind(obj):
+    """Return the kind of encoding of an instance of a subclass."""
+    for kind in (str, bool, int, float, bytes, bytearray, tuple, list, dict,
+                 set, frozenset):
+        if isinstance(obj, kind):
+            return kind
+    raise TypeError('Unsupported object type "{}".'.format(type(obj)))
+
+
+class _Counted:
+    """Hasher which counts the bytes passed to another hasher."""
+
+    def __init__(self, hasher):
+        self.hasher = hasher
+        self.size = 0
+
+    def update(self, data):
+        self.size += len(data)
+        self.hasher.update(data)
 
 
 def _checksum(hasher, obj):
@@ -117,7 +387,12 @@ def which(file, env=os.environ):
     """
     if file is None:
         return None
-    for path in env.get('PATH', '').split(os.pathsep):
+    return _which(file, env.get('PATH', ''))
+
+
+@probes.probe()
+def _which(file, directories):
+    for path in directories.split(os.pathsep):
         if path:
             result = os.path.join(path, file)
             if os.path.exists(result):
@@ -127,14 +402,20 @@ def which(file, env=os.environ):
 
 if sys.version_info >= (3, 5):
     def glob(pathname):
-        from . import loader
-        return absolute(filter(os.path.isfile, _glob.iglob(
-            loader.resolve(pathname), recursive=True)))
+        from . import fs, loader, snapshot
+        pattern = loader.resolve(pathname)
+        paths = absolute(filter(fs.isfile, map(os.path.abspath, _glob.iglob(
+            pattern, recursive=True))))
+        snapshot.observe_glob(pattern, paths)
+        return paths
 else:
     def glob(pathname):
-        from . import loader
-        return absolute(filter(os.path.isfile, _iglob(
-            loader.resolve(pathname))))
+        from . import fs, loader, snapshot
+        pattern = loader.resolve(pathname)
+        paths = absolute(filter(fs.isfile, map(os.path.abspath, _iglob(
+            pattern))))
+        snapshot.observe_glob(pattern, paths)
+        return paths
 
     def _iglob(pathname):
         """Return an iterator which yields the paths matching a pathname pattern.
@@ -260,25 +541,112 @@ class CallError(Exception):
         self.scommand = subprocess.list2cmdline(command)
         self.output = output
 
+    def __reduce__(self):
+        return CallError, (self.returned, self.command, self.output)
+
     def __str__(self):
         cmdline = subprocess.list2cmdline(self.command)
         return 'Command "{}" returned {}'.format(
             cmdline, self.returned)
 
 
+class Command:
+    """A subprocess which is requested by a rule after its publication.
+
+    Yielding a command instead of using call() allows the builder to
+    decide how the process is run. The combined output is sent back into
+    the rule, while a failure is raised at the yield as CallError.
+
+    Remote commands may be run on a worker agent (see distributed). They
+    must only read the inputs and deposits of their task and files
+    outside of the working directory.
+    """
+
+    def __init__(self, command, cwd=None, env=None, timeout=None,
+                 remote=False):
+        self.command = list(command)
+        self.cwd = cwd
+        self.env = env
+        self.timeout = timeout
+        self.remote = remote
+
+    def __repr__(self):
+        return '<Command {}>'.format(subprocess.list2cmdline(self.command))
+
+    def call(self):
+        return call(self.command, self.cwd, self.env, self.timeout)
+
+
+def command(command, cwd=None, env=None, timeout=None, remote=False):
+    """Request a subprocess - see Command."""
+    return Command(command, cwd, env, timeout, remote)
+
+
 def call(command, cwd=None, env=None, timeout=None):
     log.debug('CALL {}'.format(subprocess.list2cmdline(command)))
 
-    if env is None:
-        env = os.environ
+    env, fds = jobserver.environment(env)
+    metrics.count('spawns')
+
+    process = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env,
+        cwd=cwd, stdin=subprocess.DEVNULL, pass_fds=fds, **NEW_PROCESS_GROUP
+    )
+    track(process)
+    try:
+        output, _ = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        output, _ = process.communicate()
+        raise subprocess.TimeoutExpired(command, timeout, output) from None
+    finally:
+        untrack(process)
+    output = output.decode(errors='ignore')
+    if process.returncode:
+        raise CallError(process.returncode, command, output)
+    return output
+
+
+def track(process):
+    """Register a running process, so that terminate() can stop it."""
+    with running_lock:
+        running.add(process)
+        if not terminating:
+            return
+    _kill(process)
+
+
+def untrack(process):
+    with running_lock:
+        running.discard(process)
 
+
+def terminate():
+    """Terminate all running processes together with their children.
+
+    Those processes run in their own process group, so they do not
+    receive the interrupt of the terminal. Processes which are started
+    afterwards are terminated immediately until resume() is called.
+    """
+    global terminating
+    with running_lock:
+        terminating = True
+        processes = list(running)
+    for process in processes:
+        _kill(process)
+
+
+def resume():
+    global terminating
+    with running_lock:
+        terminating = False
+
+
+def _kill(process):
     try:
-        output = subprocess.check_output(
-            command, stderr=subprocess.STDOUT, env=env, cwd=cwd,
-            stdin=subprocess.DEVNULL, timeout=timeout,
-            **NEW_PROCESS_GROUP
-        )
-        return output.decode(errors='ignore')
-    except subprocess.CalledProcessError as e:
-        output = e.output.decode(errors='ignore')
-        raise CallError(e.returncode, e.cmd, output) from None
+        if windows:
+            process.kill()
+        else:
+            os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        pass
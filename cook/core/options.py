@@ -84,5 +84,8 @@ def option(name, type=bool, default=None, help=''):
                 .format(value)
             ) from None
 
+    from . import snapshot
+    snapshot.observe_option(name, type, default, help, value)
+
     log.debug('Evaluated option {} as {}.'.format(name, repr(result)))
     return result
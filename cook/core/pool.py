@@ -0,0 +1,102 @@
+"""Execution of offloaded rule bodies in a pool of worker processes.
+
+Rules usually run the code after their publication on the worker
+threads of the builder, which means that pure Python work is serialized
+by the GIL. A rule can avoid this by yielding the result of offload()
+instead: the given function and its arguments are then shipped to a
+separate process if the pool is enabled. Otherwise, the function is
+simply called on the worker thread.
+"""
+
+import concurrent.futures
+import multiprocessing
+import pickle
+import sys
+import threading
+
+from . import log, system
+
+size = 0
+executor = None
+lock = threading.Lock()
+
+
+class Offload:
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return '<Offload {}>'.format(getattr(self.func, '__qualname__', '?'))
+
+
+def offload(func, *args, **kwargs):
+    """Run the rest of the rule as func(*args, **kwargs).
+
+    The function must be importable and all arguments must be picklable
+    in order to be executed in a separate process. The return value is
+    treated like a deposit and must therefore be None or the result of a
+    core.deposit() call.
+    """
+    return Offload(func, args, kwargs)
+
+
+def configure(count):
+    """Set the number of processes. Zero disables the pool."""
+    global size
+    if not isinstance(count, int):
+        raise TypeError('count must be of type int')
+    elif count < 0:
+        raise ValueError('count must not be negative')
+    size = count
+
+
+def run(work):
+    """Execute the offloaded work and return its result."""
+    global executor
+
+    if size:
+        try:
+            pickle.dumps((work.func, work.args, work.kwargs))
+        except Exception as exc:
+            log.debug('Running {} in-thread, it can not be pickled: {}'
+                      .format(work, exc))
+        else:
+            with lock:
+                if executor is None:
+                    # Forking is unsafe, because other workers are running
+                    # on threads of this process at the same time. Before
+                    # Python 3.7, the executor always uses the default.
+                    options = {}
+                    if sys.version_info >= (3, 7):
+                        options['mp_context'] = \
+                            multiprocessing.get_context('spawn')
+                    executor = concurrent.futures.ProcessPoolExecutor(
+                        size, **options)
+            directories = (system.build_dir, system.intermediate_dir,
+                           system.temporary_dir)
+            future = executor.submit(
+                _call, directories, work.func, work.args, work.kwargs)
+            return future.result()
+    return work.func(*work.args, **work.kwargs)
+
+
+def shutdown():
+    global executor
+    with lock:
+        if executor is not None:
+            executor.shutdown()
+            executor = None
+
+
+def _call(directories, func, args, kwargs):
+    # Processes might not be forked, so the directories must be restored
+    # without touching the file system like system.initialize() does. They
+    # are sent along with every call, because the initializer of the
+    # executor is not available before Python 3.7.
+    build, intermediate, temporary = directories
+    system.build_dir = build
+    system.intermediate_dir = intermediate
+    system.temporary_dir = temporary
+    return func(*args, **kwargs)
@@ -0,0 +1,142 @@
+"""Results of probing the toolchain, which are kept across runs.
+
+Functions decorated with probe() are only run once per process, like
+misc.cache(), and their results are also stored in .cook/probes.pickle.
+An entry is keyed by the function, its arguments and the values of the
+given environment variables. It is only used as long as the size and
+the modification time of all files among the arguments and the result
+(e.g. the compiler) did not change. Results which are None are not
+stored, so that tools which were not found are searched for again.
+The stored results are removed with "cook --reprobe".
+"""
+
+import functools
+import os
+import pickle
+import sys
+import threading
+
+VERSION = 1
+
+entries = None
+memory = {}
+changed = False
+lock = threading.RLock()
+
+
+def probe(*variables):
+    """Keep the results of the decorated function across runs.
+
+    The results must be picklable and may depend on the arguments, the
+    given environment variables and the files mentioned in them.
+    """
+    def decorator(func):
+        name = '{}.{}'.format(func.__module__, func.__qualname__)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            global changed
+            # The variables are read through os.environ, so that they are
+            # observed by the snapshot.
+            key = repr((name, args, sorted(kwargs.items()),
+                        [os.environ.get(variable) for variable in variables]))
+            with lock:
+                if key in memory:
+                    return memory[key]
+                if entries is None:
+                    load()
+                entry = entries.get(key)
+                if entry is not None and all(
+                    _stamp(path) == stamp for path, stamp in entry[1].items()
+                ):
+                    result = entry[0]
+                else:
+                    result = func(*args, **kwargs)
+                    if result is not None:
+                        entries[key] = result, _files(args, result)
+                        changed = True
+                memory[key] = result
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+def load():
+    global entries
+    from . import log, system
+    entries = {}
+    if system.build_dir is None:
+        return
+    try:
+        with open(system.build('.cook/probes.pickle'), 'rb') as file:
+            version, data = pickle.load(file)
+    except FileNotFoundError:
+        return
+    except Exception as exc:
+        log.debug('Ignoring the cached probes: {}'.format(exc))
+        return
+    if version == VERSION:
+        # Strings are interned, so that results which are constants
+        # (e.g. cpp.GNU) can still be compared by identity.
+        entries = {key: (_intern(result), files)
+                   for key, (result, files) in data.items()}
+
+
+def save():
+    """Store the results if new probes were run."""
+    global changed
+    from . import system
+    with lock:
+        if not changed or system.build_dir is None:
+            return
+        path = system.build('.cook/probes.pickle')
+        with open(path + '.tmp', 'wb') as file:
+            pickle.dump((VERSION, entries), file)
+        os.replace(path + '.tmp', path)
+        changed = False
+
+
+def invalidate():
+    """Forget all results, so that every probe is run again."""
+    global entries, changed
+    from . import system
+    with lock:
+        entries = {}
+        memory.clear()
+        changed = False
+        try:
+            os.remove(system.build('.cook/probes.pickle'))
+        except FileNotFoundError:
+            pass
+
+
+def _intern(result):
+    if isinstance(result, str):
+        return sys.intern(result)
+    elif isinstance(result, tuple):
+        return tuple(map(_intern, result))
+    return result
+
+
+def _files(args, result):
+    """Return the stamps of the existing files among the values."""
+    values = list(args)
+    if isinstance(result, (list, tuple)):
+        values.extend(result)
+    else:
+        values.append(result)
+    return {
+        value: _stamp(value) for value in values
+        if isinstance(value, str) and os.path.isabs(value) and
+        os.path.isfile(value)
+    }
+
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
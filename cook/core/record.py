@@ -1,53 +1,261 @@
+"""Record of the previous runs, which decides whether tasks are outdated.
+
+The record is kept in .cook/record.log, to which a line is appended
+for every finished task, so that a build which is killed does not lose
+the progress it made. Every line is flushed to the operating system
+right away, but the log is only synced at the end of a build. Entries
+of tasks which do not exist anymore are removed by appending a
+tombstone. Once most of its lines are outdated, the log is compacted by
+writing the current state to a new log. A torn line at the end (e.g.
+after a crash) is ignored and cut off. The record.json of earlier
+versions is migrated.
+
+The outputs inside of the build directory are listed in .cook/manifest,
+so that outputs which are no longer declared can be found without
+walking the build directory.
+"""
+
 import json
 import os
+import threading
 
+from . import misc
 from .system import build, log
 
+# Weight of the latest measurement in the smoothed duration history.
+SMOOTHING = 0.5
+
+# The log is compacted if it has this many more lines than entries.
+SLACK = 1000
+
+# Records of version 1 contain the MD5-checksums of earlier versions.
+HEADER = ['cook-record', 2]
+LEGACY = ['cook-record', 1]
+
 data = None
+history = None
+outputs = None
+known = None
+journal = None
+lines = 0
+synced = 0
+manifest = None
+remover = None
 
 
 def load():
-    """Load serialized data if a record-file exists."""
-    global data
+    """Load the record or start an empty one."""
+    global data, history, outputs, known, journal, lines, manifest
 
-    record = build('.cook/record.json')
-    if os.path.isfile(record):
-        with open(record) as file:
-            data = json.load(file)
+    data, history, outputs, known = {}, {}, {}, {}
+    path = build('.cook/manifest')
+    if os.path.isfile(path):
+        with open(path) as file:
+            manifest = set(file.read().splitlines())
     else:
-        data = {}
+        manifest = None
+
+    path = build('.cook/record.log')
+    if not os.path.isfile(path):
+        migrated = migrate()
+        compact()
+        if migrated is not None:
+            os.remove(migrated)
+        return
+
+    with open(path, 'rb') as file:
+        content = file.read()
+    # Everything after the last newline was not written completely.
+    end = content.rfind(b'\n') + 1
+    entries = content[:end].splitlines()
+    try:
+        entries = json.loads(b'[' + b','.join(entries) + b']')
+    except ValueError:
+        entries = list(_parse(entries))
+    if not entries or entries[0] != header():
+        if entries and entries[0] in (HEADER, LEGACY):
+            log.info('Ignoring the record, since the checksums changed.')
+        elif entries:
+            log.warning('Ignoring record of an unknown format.')
+        compact()
+        return
+    for entry in entries[1:]:
+        _replay(entry)
+
+    journal = open(path, 'r+b')
+    if end != len(content):
+        log.warning('Ignoring the incomplete end of the record.')
+        journal.truncate(end)
+    journal.seek(end)
+    lines = len(entries)
+
+
+def migrate():
+    """Read the record of earlier versions and return its path, or None."""
+    path = build('.cook/record.json')
+    if not os.path.isfile(path):
+        return None
+    with open(path) as file:
+        data.update(json.load(file))
+    return path
+
+
+def legacy():
+    """Return whether the existing record contains MD5-checksums."""
+    path = build('.cook/record.log')
+    if not os.path.isfile(path):
+        # The JSON files are only written by earlier versions.
+        return os.path.isfile(build('.cook/record.json'))
+    with open(path, 'rb') as file:
+        line = file.readline()
+    try:
+        return json.loads(line) == LEGACY
+    except ValueError:
+        return False
+
+
+def header():
+    return LEGACY if misc.compatible else HEADER
 
 
 def save():
-    """Write the serialized data to the predefined location."""
-    with open(build('.cook/record.json'), 'w') as file:
-        json.dump(data, file)
+    """Make sure that the record is stored durably."""
+    global synced
+    if lines > 2 * (len(data) + len(history)) + SLACK:
+        compact()
+    elif lines != synced:
+        journal.flush()
+        os.fsync(journal.fileno())
+        synced = lines
+
+
+def compact():
+    """Replace the log by one which only contains the current state."""
+    global journal, lines, synced
+
+    path = build('.cook/record.log')
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as file:
+        _append(file, header())
+        for primary, entry in data.items():
+            _append(file, ['r', primary, entry])
+        for identity in history.keys() | outputs.keys() | known.keys():
+            _append(file, [
+                'i', identity, history.get(identity), outputs.get(identity),
+                known.get(identity)
+            ])
+        file.flush()
+        os.fsync(file.fileno())
+    if journal is not None:
+        journal.close()
+    os.replace(temporary, path)
+    journal = open(path, 'ab')
+    lines = synced = 1 + len(data) + len(
+        history.keys() | outputs.keys() | known.keys())
+
+
+def _append(file, entry):
+    file.write(json.dumps(entry, separators=(',', ':')).encode() + b'\n')
+
+
+def _parse(entries):
+    for number, entry in enumerate(entries, 1):
+        try:
+            yield json.loads(entry)
+        except ValueError:
+            log.warning('Ignoring corrupt line {} of the record.'.format(
+                number))
+
+
+def _replay(entry):
+    if entry[0] == 'r':
+        data[entry[1]] = entry[2]
+    elif entry[0] == 'i':
+        _, identity, estimate, digest, deposits = entry
+        for target, value in (
+            (history, estimate), (outputs, digest), (known, deposits)
+        ):
+            if value is not None:
+                target[identity] = value
+    elif entry[0] == '-r':
+        data.pop(entry[1], None)
+    elif entry[0] == '-i':
+        for target in (history, outputs, known):
+            target.pop(entry[1], None)
 
 
 def clean():
+    """Forget tasks which do not exist anymore and remove their outputs."""
     from . import graph  # TODO: make it better
+    global manifest, remover, lines
 
     current_primaries = {task.primary for task in graph.tasks}
 
     for primary in list(data.keys()):
         if primary not in current_primaries:
             del data[primary]
+            _append(journal, ['-r', primary])
+            lines += 1
 
-    record = os.path.abspath(build('.cook/record.json'))
+    current_identities = {identify(task) for task in graph.tasks}
+
+    for identity in history.keys() | outputs.keys() | known.keys():
+        if identity not in current_identities:
+            for target in (history, outputs, known):
+                target.pop(identity, None)
+            _append(journal, ['-i', identity])
+            lines += 1
+
+    # Outputs of the previous run which are no longer declared are
+    # removed in the background. Without a manifest, everything must be
+    # checked once.
+    root = os.path.join(os.path.abspath(build('.')), '')
+    current = {path for path, file in graph.paths.items()
+               if file.producer is not None and path.startswith(root)}
+    if manifest is None:
+        collect()
+    elif not manifest <= current:
+        if remover is not None:
+            remover.join()
+        remover = threading.Thread(
+            target=_remove, args=(sorted(manifest - current),))
+        remover.start()
+    if current != manifest:
+        path = build('.cook/manifest')
+        with open(path + '.tmp', 'w') as file:
+            file.writelines(output + '\n' for output in sorted(current))
+        os.replace(path + '.tmp', path)
+        manifest = current
+
+
+def collect():
+    """Remove all files in the build directory which are not declared."""
+    from . import graph
+
+    # The files directly inside of .cook (e.g. the record) are kept.
+    internal = build('.cook')
     temporary = build('.cook/temporary/')
 
-    # Build-directory cleaning should not really happen here.
     for root, directories, files in os.walk(build('.')):
         root = os.path.normpath(root)
-        if root.startswith(temporary):
+        if root == internal or root.startswith(temporary):
             continue
         for file in files:
             path = os.path.abspath(os.path.join(root, file))
-            if not path == record and not graph.has_file(path):
+            if not graph.has_file(path):
                 log.warning('Removing non-declared file: ' + path)
                 os.remove(path)
 
 
+def _remove(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        log.warning('Removing stale output: ' + path)
+
+
 def has_primary(primary):
     """Return true if the last run had a rule with that primary."""
     return primary in data
@@ -61,10 +269,70 @@ def get_deposits(primary):
     return data[primary][1]
 
 
+def all_deposits():
+    """Return the paths of all recorded deposits."""
+    return {path for entry in data.values() for path in entry[1]}
+
+
 def get_warnings(primary):
     return data[primary][2]
 
 
+def identify(task):
+    """Return an identifier of the task that is stable across runs.
+
+    Contrary to the primary, it only depends on the outputs, which means
+    that it survives changes of the inputs and of the check value. The
+    outputs never change, so it is only calculated once per task.
+    """
+    if task.identity is None:
+        task.identity = misc.checksum({file.path for file in task.outputs})
+    return task.identity
+
+
+def get_estimate(task):
+    """Return the smoothed execution time in seconds, if known."""
+    return history.get(identify(task))
+
+
+def compare_outputs(task, digest):
+    """Store the digest of the outputs and return True if it changed."""
+    identity = identify(task)
+    previous = outputs.get(identity)
+    outputs[identity] = digest
+    return previous is None or previous != digest
+
+
+def get_known_deposits(task):
+    """Return the deposits of the latest run of the task, if any.
+
+    Contrary to the deposits stored by primary, they are also known
+    after the inputs of the task changed.
+    """
+    return known.get(identify(task))
+
+
 def update(task):
+    """Record the finished task and append it to the log."""
+    global lines
+
     deposits = [file.path for file in task.deposits]
-    data[task.primary] = [task.secondary, deposits, task.warnings]
+    identity = identify(task)
+    data[task.primary] = [
+        task.secondary, deposits, task.warnings, task.duration]
+    known[identity] = deposits
+
+    if task.duration is not None:
+        previous = history.get(identity)
+        if previous is None:
+            history[identity] = task.duration
+        else:
+            history[identity] = (SMOOTHING * task.duration +
+                                 (1 - SMOOTHING) * previous)
+
+    _append(journal, ['r', task.primary, data[task.primary]])
+    _append(journal, [
+        'i', identity, history.get(identity), outputs.get(identity), deposits
+    ])
+    journal.flush()
+    lines += 2
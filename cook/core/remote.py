@@ -0,0 +1,303 @@
+"""Remote backend of the action cache over HTTP.
+
+Manifests and blobs of the local cache (see artifacts) are looked up at
+<url>/actions/<key> and <url>/blobs/<digest> if they are not available
+locally, and are uploaded there after a task ran unless the cache is
+read-only. Transfers run on a pool of threads with persistent
+connections. Network errors never fail a build - the remote is disabled
+for the rest of the process instead.
+
+A minimal server is included, which serves a directory with the layout
+of the local cache (cook --serve-cache PORT).
+"""
+
+import concurrent.futures
+import http.client
+import http.server
+import json
+import os
+import queue
+import re
+import shutil
+import socketserver
+import threading
+import urllib.parse
+
+from . import content, log
+
+# Seconds after which a request to the remote fails.
+TIMEOUT = 10
+
+# Number of concurrent transfers.
+THREADS = 8
+
+ENTRY = re.compile(r'^/(actions|blobs)/([0-9a-f]{2,64})$')
+
+client = None
+
+
+class Client:
+    """Connection pool and statistics for a remote cache."""
+
+    def __init__(self, url, writable):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError('unsupported remote cache: {}'.format(url))
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.writable = writable
+        self.broken = False
+        self.connections = queue.LifoQueue()
+        self.executor = concurrent.futures.ThreadPoolExecutor(THREADS)
+        self.uploads = []
+        self.configuration = (url, writable)
+        self.lock = threading.Lock()
+        self.statistics = dict.fromkeys(
+            ('hits', 'misses', 'uploads', 'downloaded', 'uploaded'), 0)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.statistics[name] += amount
+
+    def request(self, method, kind, digest, body=None, length=None):
+        """Send a request and return the response, or None on errors.
+
+        The response must be passed to release(), which returns its
+        connection to the pool.
+        """
+        if self.broken:
+            return None
+        try:
+            connection = self.connections.get_nowait()
+        except queue.Empty:
+            if self.scheme == 'https':
+                connection = http.client.HTTPSConnection(
+                    self.netloc, timeout=TIMEOUT)
+            else:
+                connection = http.client.HTTPConnection(
+                    self.netloc, timeout=TIMEOUT)
+        headers = {}
+        if length is not None:
+            headers['Content-Length'] = str(length)
+        try:
+            connection.request(method, '{}/{}/{}'.format(
+                self.prefix, kind, digest), body, headers)
+            response = connection.getresponse()
+        except (OSError, http.client.HTTPException) as exc:
+            connection.close()
+            if not self.broken:
+                self.broken = True
+                log.warning('Disabled the remote cache: {}'.format(exc))
+            return None
+        response.connection = connection
+        return response
+
+    def release(self, response):
+        try:
+            response.read()
+        except (OSError, http.client.HTTPException):
+            response.connection.close()
+            return
+        if response.will_close:
+            response.connection.close()
+        else:
+            self.connections.put(response.connection)
+
+    def manifest(self, key):
+        """Return the variants stored for the key, or None."""
+        response = self.request('GET', 'actions', key)
+        if response is None:
+            return None
+        try:
+            if response.status != 200:
+                self.count('misses')
+                return None
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            return None
+        finally:
+            self.release(response)
+        self.count('downloaded', len(data))
+        try:
+            return json.loads(data.decode())
+        except ValueError:
+            return None
+
+    def fetch(self, digests, location):
+        """Download the blobs to location(digest) and return success."""
+        missing = [digest for digest in set(digests)
+                   if not os.path.isfile(location(digest))]
+        results = self.executor.map(
+            lambda digest: self.download(digest, location(digest)), missing)
+        if not all(list(results)):
+            self.count('misses')
+            return False
+        # Blobs which are already available locally count as a hit too.
+        self.count('hits')
+        return True
+
+    def download(self, digest, path):
+        response = self.request('GET', 'blobs', digest)
+        if response is None:
+            return False
+        temporary = '{}.{}.tmp'.format(path, threading.get_ident())
+        try:
+            if response.status != 200:
+                return False
+            with open(temporary, 'wb') as file:
+                shutil.copyfileobj(response, file, content.CHUNK)
+        except (OSError, http.client.HTTPException) as exc:
+            log.debug('Could not download {}: {}'.format(digest, exc))
+            return False
+        finally:
+            self.release(response)
+        self.count('downloaded', os.path.getsize(temporary))
+        if content.compute(temporary) != digest:
+            log.warning('Remote cache sent a corrupt blob: {}'.format(digest))
+            os.remove(temporary)
+            return False
+        os.chmod(temporary, 0o444)
+        os.replace(temporary, path)
+        return True
+
+    def upload(self, key, manifest, blobs):
+        """Upload the blobs and then the manifest in the background."""
+        if self.writable and not self.broken:
+            self.uploads.append(self.executor.submit(
+                self.publish, key, manifest, blobs))
+
+    def publish(self, key, manifest, blobs):
+        for digest, path in blobs.items():
+            response = self.request('HEAD', 'blobs', digest)
+            if response is None:
+                return
+            self.release(response)
+            if response.status == 200:
+                continue
+            length = os.path.getsize(path)
+            with open(path, 'rb') as file:
+                response = self.request('PUT', 'blobs', digest, file, length)
+            if response is None:
+                return
+            self.release(response)
+            if response.status >= 300:
+                log.debug('Remote cache rejected blob {}: {}'.format(
+                    digest, response.status))
+                return
+            self.count('uploaded', length)
+        response = self.request('PUT', 'actions', key, manifest)
+        if response is not None:
+            self.release(response)
+            self.count('uploaded', len(manifest))
+            self.count('uploads')
+
+    def finish(self):
+        """Wait for the pending uploads and report the statistics."""
+        uploads, self.uploads = self.uploads, []
+        concurrent.futures.wait(uploads)
+        statistics = self.statistics
+        if any(statistics.values()):
+            log.info(
+                'Remote cache: {hits} hits, {misses} misses, {uploads} '
+                'uploads, {down:.1f} MB received, {up:.1f} MB sent'.format(
+                    down=statistics['downloaded'] / 1e6,
+                    up=statistics['uploaded'] / 1e6, **statistics))
+        self.statistics = dict.fromkeys(statistics, 0)
+
+
+def configure(url, writable=True):
+    """Use the remote cache at the URL, or none if it is None."""
+    global client
+    if client is not None and (url, writable) == client.configuration:
+        return
+    client = None
+    if url is not None:
+        client = Client(url, writable)
+
+
+def finish():
+    if client is not None:
+        client.finish()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Serve the entries of the directory of the server."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def locate(self):
+        match = ENTRY.match(self.path)
+        if match is None:
+            self.close_connection = True
+            self.send_error(404)
+            return None
+        kind, digest = match.groups()
+        return kind, digest, os.path.join(
+            self.server.directory, kind, digest[:2], digest)
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        entry = self.locate()
+        if entry is None:
+            return
+        try:
+            file = open(entry[2], 'rb')
+        except OSError:
+            self.send_error(404)
+            return
+        with file:
+            self.send_response(200)
+            self.send_header(
+                'Content-Length', str(os.fstat(file.fileno()).st_size))
+            self.end_headers()
+            if body:
+                shutil.copyfileobj(file, self.wfile, content.CHUNK)
+
+    def do_PUT(self):
+        entry = self.locate()
+        if entry is None:
+            return
+        kind, digest, path = entry
+        length = int(self.headers.get('Content-Length', 0))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(temporary, 'wb') as file:
+            while length > 0:
+                data = self.rfile.read(min(length, content.CHUNK))
+                if not data:
+                    break
+                file.write(data)
+                length -= len(data)
+        if length or kind == 'blobs' and content.compute(temporary) != digest:
+            os.remove(temporary)
+            self.send_error(400)
+            return
+        os.replace(temporary, path)
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # Like http.server.ThreadingHTTPServer, which requires Python 3.7.
+    daemon_threads = True
+
+
+def serve(directory, host='localhost', port=8080):
+    """Serve a remote cache from the directory until being interrupted."""
+    server = _Server((host, port), Handler)
+    server.directory = os.path.abspath(directory)
+    log.info('Serving the cache in {} at http://{}:{}/'.format(
+        server.directory, *server.server_address[:2]))
+    with server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
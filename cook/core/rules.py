@@ -1,8 +1,8 @@
 import functools
 import os
-import traceback
+import sys
 
-from . import graph, misc, system
+from . import fs, graph, misc, system
 
 
 def rule(func):
@@ -20,9 +20,12 @@ def task(func):
 
 def publish(
     inputs=None, message=None, outputs=None, check=None, force=False,
-    result=None, phony=False
+    result=None, phony=False, pool=None, weight=1
 ):
     """Inform the system about the task."""
+    if graph.replaying is not None:
+        # The task is restarted and was already published.
+        return None
     if inputs is None:
         inputs = set()
     elif isinstance(inputs, str):
@@ -32,9 +35,9 @@ def publish(
             'string in a list to resolve this issue.'
         )
     else:
-        inputs = set(map(os.path.abspath, inputs))
+        inputs = {sys.intern(os.path.abspath(input)) for input in inputs}
         for input in inputs:
-            if not os.path.isfile(input) and not graph.has_file(input):
+            if not graph.has_file(input) and not fs.isfile(input):
                 raise FileNotFoundError(input)
 
     if not isinstance(message, str):
@@ -62,7 +65,7 @@ def publish(
             'string in a list to resolve this issue.'
         )
     else:
-        outputs = set(map(os.path.abspath, outputs))
+        outputs = {sys.intern(os.path.abspath(output)) for output in outputs}
         for output in outputs:
             if graph.has_file(output):
                 raise ValueError('output collision')
@@ -101,9 +104,18 @@ def publish(
     if not isinstance(phony, bool):
         raise TypeError('phony must be a boolean')
 
-    stack = traceback.extract_stack()[:-3]
+    if pool is not None and not isinstance(pool, str):
+        raise TypeError('pool must be a string')
+    if not isinstance(weight, (int, float)):
+        raise TypeError('weight must be a number')
+    elif weight <= 0:
+        raise ValueError('weight must be greater than 0')
 
-    return in_files, message, out_files, check, force, result, phony, stack
+    # Skip this function, the rule and graph.spawn_task().
+    stack = graph.compact_stack(sys._getframe(3))
+
+    return (in_files, message, out_files, check, force, result, phony, pool,
+            weight, stack)
 
 
 def deposit(inputs=(), warnings=None):
@@ -113,7 +125,7 @@ def deposit(inputs=(), warnings=None):
     else:
         deposits = {os.path.abspath(path) for path in inputs}
         for path in deposits:
-            if not os.path.isfile(path):
+            if not fs.isfile(path):
                 raise FileNotFoundError(path)
             elif misc.is_inside(path, system.build('.')):
                 raise ValueError('deposit inside build directory')
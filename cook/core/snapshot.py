@@ -0,0 +1,374 @@
+"""Snapshots of the loaded graph, which make loading the scripts optional.
+
+After the scripts were loaded, all files and tasks are written to
+.cook/snapshot.pickle. The generators of the tasks are not stored -
+instead, the rule and its arguments are, so that the task can be
+restarted like in watch mode. A snapshot is only used if everything the
+scripts depended on is still the same: their contents, the imported
+Python modules, the options, the environment variables which were read,
+the results of core.glob() and the working directory.
+
+Rules are stored by reference: rules of modules by their name and rules
+defined in the scripts by the path of the script and their name. The
+latter are only available once the scripts are loaded, so if any of
+their tasks has to run, the snapshot is discarded and the scripts are
+loaded after all (see require()).
+
+Anything else the scripts might depend on (e.g. files they read on their
+own) is not tracked. Snapshots can be disabled for such projects. If
+the graph can not be pickled, this is remembered until the state of the
+scripts changes, so that the attempt is not repeated on every run.
+"""
+
+import collections.abc
+import functools
+import os
+import pickle
+import sys
+import sysconfig
+import types
+
+from . import builder, events, graph, loader, log, misc, options, system
+
+VERSION = 2
+
+# Variables which are always part of the key, because they are read
+# without going through os.environ (e.g. by misc.which()).
+ENVIRONMENT = ('PATH',)
+
+recorder = None
+globs = {}
+declared = []
+# Whether the scripts are known to produce a graph which can not be
+# pickled, in which case nothing is recorded.
+unpicklable = False
+
+
+class Reload(Exception):
+    """Raised if tasks of rules defined in the restored scripts must run."""
+
+
+class Environment(collections.abc.MutableMapping):
+    """Replacement for os.environ which records every variable read."""
+
+    def __init__(self, environ):
+        self.environ = environ
+        self.read = {}
+
+    def _observe(self, key):
+        if key not in self.read:
+            self.read[key] = self.environ.get(key)
+
+    def __getitem__(self, key):
+        self._observe(key)
+        return self.environ[key]
+
+    def __setitem__(self, key, value):
+        self._observe(key)
+        self.environ[key] = value
+
+    def __delitem__(self, key):
+        self._observe(key)
+        del self.environ[key]
+
+    def __iter__(self):
+        for key in self.environ:
+            self._observe(key)
+        return iter(self.environ)
+
+    def __len__(self):
+        return len(self.environ)
+
+    def copy(self):
+        return dict(self)
+
+
+def start():
+    """Begin to record the dependencies of the scripts."""
+    global recorder
+    if unpicklable:
+        return
+    globs.clear()
+    del declared[:]
+    recorder = Environment(os.environ)
+    os.environ = recorder
+
+
+def stop():
+    global recorder
+    if recorder is not None:
+        os.environ = recorder.environ
+        recorder = None
+
+
+def observe_glob(pattern, paths):
+    if recorder is not None:
+        globs[pattern] = misc.checksum(paths)
+
+
+def observe_option(name, type, default, help, value):
+    if recorder is not None:
+        declared.append((name, type, default, help, value))
+
+
+def location():
+    return system.build('.cook/snapshot.pickle')
+
+
+def describe(environ):
+    """Return the state the scripts depended on."""
+    modules = {}
+    stdlib = {sysconfig.get_paths()[name] for name in ('stdlib', 'platstdlib')}
+    for module in list(sys.modules.values()):
+        path = getattr(module, '__file__', None)
+        if path and not any(path.startswith(prefix) for prefix in stdlib):
+            modules[path] = _stamp(path)
+
+    variables = dict(environ.read)
+    for name in ENVIRONMENT:
+        variables[name] = environ.environ.get(name)
+
+    return {
+        'version': (VERSION, sys.version),
+        'cwd': os.getcwd(),
+        'scripts': {path: _digest(path) for path in loader.loaded},
+        'modules': modules,
+        'environment': variables,
+        'globs': dict(globs),
+        'options': list(declared),
+    }
+
+
+def validate(state):
+    """Return the reason why the state is outdated, or None."""
+    if state['version'] != (VERSION, sys.version):
+        return 'different version'
+    elif state['cwd'] != os.getcwd():
+        return 'different working directory'
+    for path, digest in state['scripts'].items():
+        if _digest(path) != digest:
+            return 'changed script {}'.format(path)
+    for path, stamp in state['modules'].items():
+        if _stamp(path) != stamp:
+            return 'changed module {}'.format(path)
+    for name, value in state['environment'].items():
+        if os.environ.get(name) != value:
+            return 'changed environment variable {}'.format(name)
+    for pattern, digest in state['globs'].items():
+        if misc.checksum(misc.glob(pattern)) != digest:
+            return 'changed glob {}'.format(pattern)
+    for name, type, default, help, value in state['options']:
+        if events.on_option(name, type, default, help) != value:
+            return 'changed option {}'.format(name)
+    return None
+
+
+def save():
+    """Write the loaded graph together with its dependencies."""
+    environ = recorder
+    stop()
+    if environ is None:
+        return
+
+    files = list(graph.paths.values())
+    tasks = list(graph.tasks)
+    ids = {}
+    for index, file in enumerate(files):
+        ids[id(file)] = ('file', index)
+    for index, task in enumerate(tasks):
+        ids[id(task)] = ('task', index)
+        ids[id(task.result)] = ('result', index)
+
+    details = [(
+        task.message, task.check, task.force, task.phony, task.pool,
+        task.weight, task.stack, task.rule, task.directory, task.children,
+        [ids[id(file)][1] for file in task.inputs],
+        [ids[id(file)][1] for file in task.outputs],
+        {key: value for key, value in task.result.__dict__.items()
+         if key != '_task'}
+    ) for task in tasks]
+    defaults = [ids[id(task)][1] for task in builder.defaults]
+
+    path = location()
+    temporary = path + '.tmp'
+    state = describe(environ)
+    try:
+        with open(temporary, 'wb') as file:
+            pickle.dump(state, file, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(
+                ([(file.path, file.phony) for file in files], len(tasks)),
+                file, pickle.HIGHEST_PROTOCOL)
+            pickler = Pickler(file, ids)
+            pickler.dump((details, defaults, dict(builder.capacities)))
+    except Exception as exc:
+        log.warning('Could not save a snapshot, the scripts are loaded on '
+                    'every run until they change: {}'.format(exc))
+        # Only the state is stored, which marks the scripts as unpicklable.
+        with open(temporary, 'wb') as file:
+            pickle.dump(state, file, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(None, file, pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, path)
+
+
+def discard():
+    """Remove the snapshot, so that the scripts are loaded next time."""
+    try:
+        os.remove(location())
+    except FileNotFoundError:
+        pass
+
+
+def require(tasks):
+    """Raise Reload if any of the tasks needs a rule of the scripts."""
+    for task in tasks:
+        if task.rule is not None and isinstance(task.rule[0], Script):
+            raise Reload('{} needs the rule {} of {}'.format(
+                task.message, task.rule[0].__qualname__, task.rule[0].path))
+
+
+def restore():
+    """Load the graph from the snapshot if it is up-to-date.
+
+    Returns True on success. The scripts must be loaded otherwise.
+    """
+    global unpicklable
+    unpicklable = False
+    path = location()
+    if not os.path.isfile(path):
+        return False
+
+    with open(path, 'rb') as file:
+        try:
+            state = pickle.load(file)
+            reason = validate(state)
+            if reason is not None:
+                log.debug('Snapshot is outdated: {}'.format(reason))
+                return False
+            entries = pickle.load(file)
+            if entries is None:
+                log.debug('Snapshot is not taken of these scripts.')
+                unpicklable = True
+                return False
+            paths, count = entries
+            files = []
+            for path, phony in paths:
+                new = graph.File(path)
+                new.phony = phony
+                files.append(new)
+            tasks = []
+            for _ in range(count):
+                task = graph.Task(None, None, None, False, False, None, 1, ())
+                task.result = graph.Result()
+                task.result._task = task
+                tasks.append(task)
+            details, defaults, capacities = Unpickler(
+                file, files, tasks).load()
+        except Exception as exc:
+            log.debug('Could not load snapshot: {}'.format(exc))
+            return False
+
+    for task, detail in zip(tasks, details):
+        (task.message, task.check, task.force, task.phony, task.pool,
+         task.weight, task.stack, task.rule, task.directory, task.children,
+         inputs, outputs, result) = detail
+        task.result.__dict__.update(result)
+        for index in inputs:
+            task.inputs.add(files[index])
+            files[index].dependants.add(task)
+        for index in outputs:
+            task.outputs.add(files[index])
+            files[index].producer = task
+
+    graph.paths.update((file.path, file) for file in files)
+    graph.tasks.update(tasks)
+    builder.defaults.update(tasks[index] for index in defaults)
+    builder.capacities.update(capacities)
+    options.requested.update(option[0] for option in state['options'])
+    loader.loaded.update(dict.fromkeys(state['scripts']))
+    log.debug('Restored {} tasks from the snapshot.'.format(len(tasks)))
+    return True
+
+
+class Pickler(pickle.Pickler):
+    def __init__(self, file, ids):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.ids = ids
+
+    def persistent_id(self, obj):
+        if isinstance(obj, types.FunctionType):
+            return _reference(obj)
+        return self.ids.get(id(obj))
+
+
+class Unpickler(pickle.Unpickler):
+    def __init__(self, file, files, tasks):
+        super().__init__(file)
+        self.files = files
+        self.tasks = tasks
+
+    def persistent_load(self, pid):
+        kind, index = pid[:2]
+        if kind == 'file':
+            return self.files[index]
+        elif kind == 'task':
+            return self.tasks[index]
+        elif kind == 'result':
+            return self.tasks[index].result
+        elif kind == 'rule':
+            __import__(index)
+            return getattr(sys.modules[index], pid[2]).args[0]
+        else:
+            return Script(index, pid[2])
+
+
+class Script:
+    """Placeholder for a rule which was defined in a script."""
+
+    def __init__(self, path, qualname):
+        self.path = path
+        # Like the functions of scripts, which have no module.
+        self.__module__ = None
+        self.__qualname__ = qualname
+
+    def __call__(self, *args, **kwargs):
+        raise Reload('the rule {} of {} is not loaded'.format(
+            self.__qualname__, self.path))
+
+
+def _reference(func):
+    """Return the persistent ID of a rule, or None for other functions.
+
+    The name of a rule refers to the wrapper created by core.rule, so the
+    generator function can not be pickled by its name.
+    """
+    path = func.__globals__.get('__file__')
+    if path in loader.loaded:
+        wrapper = func.__globals__.get(func.__qualname__)
+        kind, location = 'script', path
+    else:
+        module = sys.modules.get(func.__module__)
+        wrapper = getattr(module, func.__qualname__, None)
+        kind, location = 'rule', func.__module__
+    if (
+        isinstance(wrapper, functools.partial) and
+        wrapper.func is graph.spawn_task and
+        wrapper.args == (func,)
+    ):
+        return kind, location, func.__qualname__
+    return None
+
+
+def _stamp(path):
+    try:
+        result = os.stat(path)
+    except OSError:
+        return None
+    return result.st_mtime_ns, result.st_size
+
+
+def _digest(path):
+    try:
+        with open(path, 'rb') as file:
+            return misc.checksum(file.read())
+    except OSError:
+        return None
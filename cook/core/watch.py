@@ -0,0 +1,224 @@
+"""Continuous rebuilds whenever watched files change.
+
+The loaded graph is kept between builds. The directories of all inputs,
+deposits and build scripts are watched with inotify on Linux, while
+other platforms fall back to polling the watched files. Only the files
+which changed are stat'ed again and only the tasks using them need a
+new primary. If a build script changed, the caller has to load all
+scripts again.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+from . import fs, graph, loader, log, record
+
+# After a change, further changes are collected until there was none for
+# this long, so that a burst of editor writes only causes one build.
+DEBOUNCE = 0.05
+
+# Interval in seconds in which the fallback polls the watched files.
+INTERVAL = 0.5
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ONLYDIR = 0x01000000
+
+MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+        IN_CREATE | IN_DELETE | IN_ONLYDIR)
+
+EVENT = struct.Struct('iIII')
+
+
+class Inotify:
+    """Watch the directories of the paths with inotify."""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.paths = set()
+        self.watches = {}
+        self.directories = set()
+
+    def update(self, paths):
+        self.paths = paths
+        for directory in {os.path.dirname(path) for path in paths}:
+            if directory in self.directories:
+                continue
+            descriptor = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(directory), MASK)
+            if descriptor < 0:
+                log.debug('Could not watch {}: {}'.format(
+                    directory, os.strerror(ctypes.get_errno())))
+                continue
+            self.watches[descriptor] = directory
+            self.directories.add(directory)
+
+    def read(self, timeout):
+        """Return the watched paths which changed within the timeout."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            descriptor, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, so everything could have changed.
+                changed.update(self.paths)
+            elif descriptor in self.watches and name:
+                changed.add(os.path.join(
+                    self.watches[descriptor], os.fsdecode(name)))
+        return changed & self.paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Poller:
+    """Watch the paths by comparing their metadata regularly."""
+
+    def __init__(self):
+        self.paths = set()
+        self.stamps = {}
+
+    def update(self, paths):
+        self.paths = paths
+        for path in paths:
+            if path not in self.stamps:
+                self.stamps[path] = _stamp(path)
+
+    def read(self, timeout):
+        """Return the watched paths which changed within the timeout."""
+        time.sleep(INTERVAL if timeout is None else timeout)
+        changed = set()
+        for path in self.paths:
+            stamp = _stamp(path)
+            if stamp != self.stamps[path]:
+                self.stamps[path] = stamp
+                changed.add(path)
+        return changed
+
+    def close(self):
+        pass
+
+
+def _stamp(path):
+    try:
+        result = os.stat(path)
+    except OSError:
+        return None
+    return result.st_mtime_ns, result.st_size
+
+
+def create():
+    """Return an inotify watcher if possible, otherwise a poller."""
+    if sys.platform.startswith('linux'):
+        try:
+            return Inotify()
+        except (OSError, AttributeError) as exc:
+            log.debug('Could not use inotify: {}'.format(exc))
+    log.debug('Polling for changes.')
+    return Poller()
+
+
+def watched(outputs=False):
+    """Return all paths whose change may require a rebuild.
+
+    Outputs are only included on request, because they are changed by
+    the build itself.
+    """
+    paths = set(loader.loaded)
+    for file in graph.paths.values():
+        if outputs or file.producer is None:
+            paths.add(file.path)
+    if record.data is not None:
+        for path in record.all_deposits():
+            file = graph.try_file(path)
+            if file is None or file.producer is None:
+                paths.add(path)
+    return paths
+
+
+def wait(watcher):
+    """Block until watched paths changed and return them."""
+    changed = set()
+    while not changed:
+        changed = watcher.read(None)
+    while True:
+        more = watcher.read(DEBOUNCE)
+        if not more:
+            return changed
+        changed.update(more)
+
+
+def pending(watcher):
+    """Return the watched paths which changed without blocking."""
+    changed = set()
+    while True:
+        more = watcher.read(0)
+        if not more:
+            return changed
+        changed.update(more)
+
+
+def invalidate(paths):
+    """Update the changed files and reset the primaries depending on them.
+
+    Deposits do not need any special treatment, because the secondary of
+    every task is compared to the record on each build anyway.
+    """
+    for path in paths:
+        fs.invalidate(path)
+        file = graph.try_file(path)
+        if file is not None:
+            file.stat()
+            for task in file.dependants:
+                task.primary = None
+
+
+def run(build):
+    """Call build() once and again whenever a watched file changed.
+
+    Changes during a build are picked up right afterwards. Returns the
+    changed build scripts as soon as there are any.
+    """
+    watcher = create()
+    try:
+        watcher.update(watched())
+        while True:
+            build()
+            watcher.update(watched())
+            log.info('Watching {} files for changes.'.format(
+                len(watcher.paths)))
+            changed = wait(watcher)
+            for path in sorted(changed):
+                log.debug('Changed: {}'.format(path))
+            scripts = changed.intersection(loader.loaded)
+            if scripts:
+                return scripts
+            invalidate(changed)
+    finally:
+        watcher.close()
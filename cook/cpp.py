@@ -69,7 +69,8 @@ def executable(
         result={
             'type': 'cpp.executable'
         },
-        check=linkflags
+        check=linkflags,
+        pool='link'
     )
 
     if toolchain is GNU:
@@ -81,12 +82,12 @@ def executable(
             command.append('-Wl,-rpath,' + os.path.dirname(core.absolute(s)))
         command.append('-lstdc++')
         command.extend(linkflags)
-        core.call(command)
+        yield core.command(command)
     elif toolchain is MSVC:
         command = [compiler, '/Fe' + name, '/nologo']
         command.extend(objects + shared + static)
         command.extend(linkflags)
-        core.call(command, env=_msvc_get_cl_env(compiler))
+        yield core.command(command, env=_msvc_get_cl_env(compiler))
 
 
 @core.rule
@@ -150,13 +151,13 @@ def static_library(
         command = [archiver, 'rs', name]
         command.extend(objects)
         command.extend(linkflags)
-        core.call(command)
+        yield core.command(command)
     elif toolchain is MSVC:
         archiver = os.path.join(os.path.dirname(compiler), 'lib.exe')
         command = [archiver, '/OUT:' + name]
         command.extend(objects)
         command.extend(linkflags)
-        core.call(command, env=_msvc_get_cl_env(compiler))
+        yield core.command(command, env=_msvc_get_cl_env(compiler))
 
 
 @core.rule
@@ -221,7 +222,8 @@ def shared_library(
             'headers': core.absolute(core.resolve(headers)),
             'output': core.absolute(name)
         },
-        check=linkflags
+        check=linkflags,
+        pool='link'
     )
 
     if toolchain is GNU:
@@ -229,12 +231,12 @@ def shared_library(
         command.extend(objects)
         command.append('-Wl,-soname,' + os.path.basename(name))
         command.extend(linkflags)
-        core.call(command)
+        yield core.command(command)
     elif toolchain is MSVC:
         command = [compiler, '/Fe' + name, '/nologo', '/LD']
         command.extend(objects)
         command.extend(linkflags)
-        core.call(command, env=_msvc_get_cl_env(compiler))
+        yield core.command(command, env=_msvc_get_cl_env(compiler))
         base = os.path.splitext(name)[0]
         if not msvc_lib:
             origin = base + '.lib'
@@ -338,7 +340,7 @@ def object(
 
         command.extend(flags)
 
-        output = core.call(command)
+        output = yield core.command(command, remote=True)
 
         if scan:
             # TODO: Good parsing.
@@ -392,7 +394,8 @@ def object(
         command.extend(flags)
 
         try:
-            output = core.call(command, env=_msvc_get_cl_env(compiler))
+            output = yield core.command(
+                command, env=_msvc_get_cl_env(compiler))
         except core.CallError as exc:
             exc.output = _msvc_strip_includes(exc.output)
             raise
@@ -430,6 +433,7 @@ GNU = 'GNU'
 MSVC = 'MSVC'
 
 
+@core.probe('CXX', 'PATH')
 def _find(name):
     if core.windows:
         env = _msvc_get_cl_env(_get_default_compiler()[0])
@@ -458,7 +462,10 @@ def _find(name):
                 return path
 
 
-@core.cache
+@core.probe('CXX', 'PATH', 'ProgramFiles(x86)', *(
+    'VS{}COMNTOOLS'.format(version)
+    for version in (140, 120, 110, 100, 90, 80, 71, 70)
+))
 def _get_default_compiler():
     compiler = os.environ.get('CXX')
     if compiler is not None:
@@ -510,7 +517,7 @@ def _msvc_get_cl_env(cl):
     raise ValueError('could not extract env')
 
 
-@core.cache
+@core.probe()
 def _msvc_extract_vcvars(vcvars):
     core.debug('Extracting environment of {}'.format(vcvars))
     helper = core.temporary(core.random('.bat'))
@@ -581,7 +588,7 @@ def _msvc_extract_includes(output):
     return used
 
 
-@core.cache
+@core.probe()
 def _gnu_supports_colors(compiler):
     try:
         core.call([compiler, '-fdiagnostics-color'])
@@ -22,8 +22,8 @@ def cmake(directory, retrieve):
 
     temp = core.temporary(core.random())
     os.mkdir(temp)
-    core.call([exe, directory], cwd=temp, env=os.environ)
-    core.call([exe, '--build', '.'], cwd=temp, env=os.environ)
+    yield core.command([exe, directory], cwd=temp, env=os.environ)
+    yield core.command([exe, '--build', '.'], cwd=temp, env=os.environ)
 
     for file in retrieve:
         source = os.path.join(temp, retrieve[file])
@@ -48,7 +48,7 @@ def ninja(directory, retrieve):
 
     temp = core.temporary(core.random())
     shutil.copytree(directory, temp)
-    core.call([exe], cwd=temp, env=os.environ)
+    yield core.command([exe], cwd=temp, env=os.environ)
 
     for file in retrieve:
         source = os.path.join(temp, retrieve[file])
@@ -73,7 +73,7 @@ def make(directory, retrieve):
 
     temp = core.temporary(core.random())
     shutil.copytree(directory, temp)
-    core.call([exe], cwd=temp, env=os.environ)
+    yield core.command([exe], cwd=temp, env=os.environ)
 
     for file in retrieve:
         source = os.path.join(temp, retrieve[file])
@@ -98,7 +98,8 @@ def cook(directory, retrieve):
 
     temp = core.temporary(core.random())
     os.mkdir(temp)
-    core.call([exe, '-o', temp], cwd=directory, env=os.environ)
+    yield core.command(
+        [exe, '-o', temp], cwd=directory, env=os.environ)
 
     for file in retrieve:
         source = os.path.join(temp, retrieve[file])
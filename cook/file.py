@@ -18,20 +18,7 @@ def extract(archive, mapping):
         message='Extracting {}'.format(archive)
     )
 
-    if zipfile.is_zipfile(archive):
-        with zipfile.ZipFile(archive) as zip:
-            for path, destination in mapping.items():
-                with zip.open(path) as member:
-                    with open(core.build(destination), 'wb') as output:
-                        shutil.copyfileobj(member, output)
-    elif tarfile.is_tarfile(archive):
-        with tarfile.open(archive) as tar:
-            for path, destination in mapping.items():
-                with tar.extractfile(path) as member:
-                    with open(core.build(destination), 'wb') as output:
-                        shutil.copyfileobj(member, output)
-    else:
-        raise ValueError('Unsupported file: ' + archive)
+    yield core.offload(_extract, archive, mapping)
 
 
 @core.rule
@@ -45,9 +32,7 @@ def copy(input, output):
         message='Copy {} to {}'.format(input, output),
     )
 
-    with open(input, 'rb') as infile:
-        with open(output, 'wb') as outfile:
-            outfile.write(infile.read())
+    yield core.offload(_copy, input, output)
 
 
 @core.rule
@@ -70,16 +55,7 @@ def template(
         check=[mapping, left, right]
     )
 
-    with open(source, 'r') as infile:
-        content = infile.read()
-    for key, value in mapping.items():
-        key = left + key + right
-        if key in content:
-            content = content.replace(key, value)
-        else:
-            raise ValueError('key "{}" not in content'.format(key))
-    with open(destination, 'w') as outfile:
-        outfile.write(content)
+    yield core.offload(_template, source, destination, mapping, left, right)
 
 
 @core.rule
@@ -124,3 +100,39 @@ def download(url, sha256=None, destination=None):
         )
     elif sha256 != 'IGNORE' and checksum != sha256:
         raise ValueError('Expected SHA256 {}, got {}'.format(sha256, checksum))
+
+
+def _extract(archive, mapping):
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zip:
+            for path, destination in mapping.items():
+                with zip.open(path) as member:
+                    with open(core.build(destination), 'wb') as output:
+                        shutil.copyfileobj(member, output)
+    elif tarfile.is_tarfile(archive):
+        with tarfile.open(archive) as tar:
+            for path, destination in mapping.items():
+                with tar.extractfile(path) as member:
+                    with open(core.build(destination), 'wb') as output:
+                        shutil.copyfileobj(member, output)
+    else:
+        raise ValueError('Unsupported file: ' + archive)
+
+
+def _copy(input, output):
+    with open(input, 'rb') as infile:
+        with open(output, 'wb') as outfile:
+            outfile.write(infile.read())
+
+
+def _template(source, destination, mapping, left, right):
+    with open(source, 'r') as infile:
+        content = infile.read()
+    for key, value in mapping.items():
+        key = left + key + right
+        if key in content:
+            content = content.replace(key, value)
+        else:
+            raise ValueError('key "{}" not in content'.format(key))
+    with open(destination, 'w') as outfile:
+        outfile.write(content)
@@ -46,8 +46,8 @@ def document(
     # How many times should this be done? Sometimes one is enough, sometimes
     # two or even more. It seems it is possible to determine it - this is very
     # important to avoid unnecessary rebuilds.
-    core.call(cmd, env=env)
-    core.call(cmd, env=env)
+    yield core.command(cmd, env=env)
+    yield core.command(cmd, env=env)
 
     pdf = os.path.join(aux_dir, 'document.pdf')
     os.rename(pdf, name)
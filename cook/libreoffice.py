@@ -39,6 +39,6 @@ def convert(source, destination=None, format=None):
     os.mkdir(out_dir)
     command = [_soffice, '--headless', '--convert-to', format,
                '--outdir', out_dir, source]
-    core.call(command)
+    yield core.command(command)
     out_path = os.path.join(out_dir, in_base + '.' + format)
     os.rename(out_path, destination)
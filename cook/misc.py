@@ -4,7 +4,7 @@ from cook import core
 @core.rule
 def run(
     command, outputs, inputs=None, message=None, env=None, timeout=None,
-    cwd=None
+    cwd=None, remote=False
 ):
     inputs = core.resolve(inputs or [])
     outputs = core.build(outputs)
@@ -25,4 +25,4 @@ def run(
             real.extend(outputs)
         else:
             real.append(token)
-    core.call(real, env=env, timeout=timeout, cwd=cwd)
+    yield core.command(real, env=env, timeout=timeout, cwd=cwd, remote=remote)